@@ -2,6 +2,7 @@
 
 import argparse
 import logging
+from os import cpu_count
 
 from BarcodeFinder import utils
 from BarcodeFinder import gb2fasta
@@ -33,6 +34,8 @@ def parse_args():
     general.add_argument('-fasta', help='unaligned fasta format data to add')
     general.add_argument('-gb', help='genbank files')
     general.add_argument('-out', help='output directory')
+    general.add_argument('-threads', type=int, default=max(1, cpu_count()-1),
+                         help='number of threads')
     gb2fasta_ = arg.add_argument_group('GB2Fasta')
     # genes in IR regions
     gb2fasta_.add_argument('-allow_mosaic_spacer', action='store_true',
@@ -44,6 +47,10 @@ def parse_args():
     # for primer
     gb2fasta_.add_argument('-expand', type=int, default=0,
                            help='expand length of upstream/downstream')
+    gb2fasta_.add_argument('-filter_gene', nargs='*',
+                           help='only divide records having these genes')
+    gb2fasta_.add_argument('-filter_taxon', nargs='*',
+                           help='only divide records of these taxa')
     gb2fasta_.add_argument('-max_name_len', default=100, type=int,
                            help='maximum length of feature name')
     # handle rps12
@@ -57,6 +64,9 @@ def parse_args():
     gb2fasta_.add_argument('-unique', choices=('longest', 'first', 'no'),
                            default='first',
                            help='method to remove redundant sequences')
+    gb2fasta_.add_argument('-unique_seq', action='store_true',
+                           help='remove identical sequences of different '
+                                'species')
     gb2fasta_.add_argument('-email', type=str,
                            help='email address for querying Genbank')
     gb2fasta_.add_argument('-exclude', type=str, help='exclude option')
@@ -102,6 +112,9 @@ def parse_args():
                           help='window size')
     evaluate.add_argument('-step', default=50, type=int,
                           help='step length for sliding-window scan')
+    evaluate.add_argument('-tree_engine', choices=('iqtree', 'nj'),
+                          default='iqtree',
+                          help='method to build trees of windows')
     evaluate.add_argument('-skip_primer', action='store_true',
                           help='skip primer designing')
     primer = arg.add_argument_group('Primer')
@@ -109,6 +122,9 @@ def parse_args():
                         type=int, help='number of ambiguous bases')
     primer.add_argument('-coverage', dest='coverage', default=0.5, type=float,
                         help='minimal coverage of base and primer')
+    primer.add_argument('-max_expand', default=256, type=utils.positive_int,
+                        help='maximum number of expanded sequences of '
+                             'ambiguous primer')
     primer.add_argument('-mismatch', dest='mismatch', default=4, type=int,
                         help='maximum mismatch bases in primer')
     primer.add_argument('-pmin', dest='min_primer', default=20, type=int,
@@ -1,17 +1,25 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import logging
+import mmap
 import sys
 import numpy as np
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from io import StringIO
 from os import devnull, cpu_count
 from pathlib import Path
+from shutil import rmtree
 from subprocess import run
+from tempfile import mkdtemp
+from threading import Lock
 
 from Bio import Phylo, SeqIO
+from Bio.Data.IUPACData import ambiguous_dna_values
 from matplotlib import use as mpl_use
 mpl_use('Agg')
 from matplotlib import pyplot as plt
@@ -33,6 +41,20 @@ try:
 except ImportError:
     pass
 
+# 4-bit bitmask of bases, see get_code_table()
+A, C, G, T = 1, 2, 4, 8
+GAP = 0
+ANY = A | C | G | T
+UNKNOWN = 16
+CODES = UNKNOWN + 1
+# options of IQ-TREE, also used as key of TreeCache
+IQTREE_OPTION = '-m HKY -fast -czb'
+NJ_OPTION = 'nj k2p'
+# branches shorter than it were collapsed, same as IQ-TREE
+MIN_BRANCH = 1e-6
+TREE_CACHE_FILE = 'tree_cache.json'
+_tree_cache = None
+
 
 def parse_args():
     arg = argparse.ArgumentParser(
@@ -44,6 +66,8 @@ def parse_args():
     arg.add_argument('-out', help='output folder')
     arg.add_argument('-skip_primer', action='store_true',
                      help='skip primer designing')
+    arg.add_argument('-threads', type=int, default=max(1, cpu_count()-1),
+                     help='number of threads')
     options = arg.add_argument_group('Options')
     options.add_argument('-ig', '-ignore_gap', dest='ignore_gap',
                          action='store_true',
@@ -59,6 +83,9 @@ def parse_args():
                                 help='window size')
     sliding_window.add_argument('-step', type=int, default=50,
                                 help='step length')
+    sliding_window.add_argument('-tree_engine', choices=('iqtree', 'nj'),
+                                default='iqtree',
+                                help='method to build trees of windows')
     return arg.parse_known_args()
 
 
@@ -151,6 +178,7 @@ def array_to_fasta(alignment: np.array, filename: Path) -> Path:
     """
     Convert np.array to fasta.
     Use index number as sequence id.
+    Bitmask code were decoded to IUPAC bytes.
     Args:
         alignment
         filename
@@ -160,55 +188,201 @@ def array_to_fasta(alignment: np.array, filename: Path) -> Path:
     with open(filename, 'wb') as aln:
         for index, row in enumerate(alignment):
             aln.write(b'>'+str(index).encode('utf-8')+b'\n')
-            aln.write(b''.join(row)+b'\n')
+            aln.write(DECODE_TABLE[row].tobytes()+b'\n')
     return filename
 
 
-def fasta_to_array(aln_fasta: Path) -> (np.array, np.array):
+def get_code_table() -> (np.array, np.array, np.array):
+    """
+    Lookup tables of 4-bit IUPAC bitmask, one bit for each base
+    (A=1, C=2, G=4, T=8), thus ambiguous bases are union of bits, gap is 0,
+    "N", "X" and "?" are 15. Other bytes are UNKNOWN.
+    Lowercase letters were folded to uppercase in the same pass.
+    Returns:
+        encode: np.array(256, uint8), byte to code
+        decode: np.array(CODES, uint8), code to byte
+        bit_count: np.array(CODES, int64), number of bases of each code
+    """
+    bits = {'A': A, 'C': C, 'G': G, 'T': T}
+    encode = np.full(256, UNKNOWN, dtype=np.uint8)
+    decode = np.full(CODES, ord('?'), dtype=np.uint8)
+    for base, value in ambiguous_dna_values.items():
+        code = sum(bits[i] for i in value)
+        encode[ord(base)] = encode[ord(base.lower())] = code
+        if base != 'X':
+            decode[code] = ord(base)
+    encode[ord('?')] = ANY
+    encode[ord('-')] = GAP
+    decode[GAP] = ord('-')
+    bit_count = np.array([bin(i).count('1') for i in range(UNKNOWN)]+[0],
+                         dtype=np.int64)
+    return encode, decode, bit_count
+
+
+ENCODE_TABLE, DECODE_TABLE, BIT_COUNT = get_code_table()
+
+
+def load_sidecar(aln_fasta: Path, sidecar: Path) -> (np.array, np.array):
+    """
+    Reopen array saved by fasta_to_array with mmap_mode, only if it is newer
+    than the fasta file.
+    Args:
+        aln_fasta(Path): aligned fasta file
+        sidecar(Path): npy file of sequence array
+    Returns:
+        name(np.array): name array, None if not available
+        sequence(np.array): sequence array, None if not available
+    """
+    name_file = sidecar.with_suffix('.name.npy')
+    try:
+        if (sidecar.stat().st_mtime < aln_fasta.stat().st_mtime or
+                name_file.stat().st_mtime < aln_fasta.stat().st_mtime):
+            return None, None
+        name_array = np.load(name_file)
+        sequence_array = np.load(sidecar, mmap_mode='r')
+    except (OSError, ValueError):
+        return None, None
+    if (name_array.shape[0] != sequence_array.shape[0] or
+            sequence_array.dtype != np.uint8):
+        return None, None
+    log.debug(f'Load {aln_fasta} from {sidecar}.')
+    return name_array, sequence_array
+
+
+def fasta_to_array(aln_fasta: Path, sidecar=None) -> (np.array, np.array):
     """
     Given fasta format alignment filename, return a numpy array for sequence:
-    Faster and use smaller mem.
-    Ensure all bases are capital.
+    The file is memory-mapped and record boundaries are located in bulk, so
+    only one copy of sequences is hold in memory.
+    Bases are converted to bitmask code (see get_code_table()) at the same
+    time.
+    If sidecar is given, the array is saved as npy file and reopened with
+    mmap_mode next time.
     Args:
         aln_fasta(Path): aligned fasta file
+        sidecar(Path or None): npy file to cache sequence array
     Returns:
         name(np.array): name array
-        sequence(np.array): sequence array
+        sequence(np.array): sequence array, uint8
     """
-    data = []
-    record = ['id', 'sequence']
-    with open(aln_fasta, 'r', encoding='utf-8') as raw:
-        for line in raw:
-            if line.startswith('>'):
-                data.append([record[0], ''.join(record[1:])])
-                # remove ">" and CRLF
-                name = line[1:].strip()
-                record = [name, '']
-            else:
-                record.append(line.strip().upper())
-        # add last sequence
-        data.append([record[0], ''.join(record[1:])])
-    # skip head['id', 'seq']
-    data = data[1:]
+    if sidecar is not None:
+        name_array, sequence_array = load_sidecar(aln_fasta, sidecar)
+        if name_array is not None:
+            return name_array, sequence_array
+    newline = ord('\n')
+    with open(aln_fasta, 'rb') as raw:
+        try:
+            mm = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            log.error(f'Invalid alignment file {aln_fasta}')
+            return None, None
+    data = np.frombuffer(mm, dtype=np.uint8)
+    line_start = np.empty(data.shape, dtype=np.bool_)
+    line_start[0] = True
+    np.equal(data[:-1], newline, out=line_start[1:])
+    head_start = np.flatnonzero(line_start & (data == ord('>')))
+    del line_start
+    if len(head_start) == 0:
+        log.error(f'Invalid alignment file {aln_fasta}')
+        del data
+        mm.close()
+        return None, None
+    newlines = np.append(np.flatnonzero(data == newline), len(data))
+    head_end = newlines[np.searchsorted(newlines, head_start)]
+    del newlines
+    # remove ">" and CRLF
+    names = [bytes(data[start+1:end]).strip().decode('utf-8')
+             for start, end in zip(head_start, head_end)]
+    # mark bytes of head lines, int8 is enough since heads do not overlap
+    mark = np.zeros(len(data)+1, dtype=np.int8)
+    mark[head_start] = 1
+    mark[head_end] -= 1
+    # skip lines before first record and whitespace
+    mark[0] += 1
+    mark[head_start[0]] -= 1
+    keep = np.cumsum(mark[:-1], dtype=np.int8) == 0
+    del mark
+    keep &= data > ord(' ')
     # check sequence length
-    length_check = [len(i[1]) for i in data]
+    length_check = np.add.reduceat(keep, head_start, dtype=np.int64)
     if len(set(length_check)) != 1:
         log.error(f'Invalid alignment file {aln_fasta}')
+        del data, keep
+        mm.close()
         return None, None
-    # Convert List to numpy array.
-    # order 'F' is a bit faster than 'C'
-    # new = np.hstack((name, seq)) -> is slower
-    name_array = np.array([[i[0]] for i in data], dtype=np.bytes_)
-    # fromiter is faster than from list
-    # S1: bytes
-    sequence_array = np.array(
-        [np.fromiter(i[1], dtype=np.dtype('S1')) for i in data],
-        order='F')
-    if name_array is None:
-        log.error('Bad fasta file {}.'.format(aln_fasta))
+    sequence = data[keep]
+    del data, keep
+    mm.close()
+    np.take(ENCODE_TABLE, sequence, out=sequence)
+    name_array = np.array([[i] for i in names], dtype=np.bytes_)
+    sequence_array = sequence.reshape(len(names), length_check[0])
+    if sidecar is not None:
+        try:
+            np.save(sidecar, sequence_array)
+            np.save(sidecar.with_suffix('.name.npy'), name_array)
+        except OSError:
+            log.debug(f'Cannot write {sidecar}.')
     return name_array, sequence_array
 
 
+def count_column(alignment: np.array, axis=0) -> (np.array, np.array):
+    """
+    Count each kind of base in every column.
+    Only bases exist in the alignment are counted, which is much faster than
+    calling np.unique on every column.
+    Args:
+        alignment: np.array
+        axis: 0 for column, 1 for row
+    Returns:
+        bases: np.array of bases (code) that exist in the alignment
+        count: np.array, (len(bases), columns), count of each base in each
+        column, or (len(bases), rows) if axis is 1
+    """
+    bases = np.flatnonzero(np.bincount(alignment.ravel(),
+                                       minlength=CODES)).astype(np.uint8)
+    count = np.zeros((len(bases), alignment.shape[1-axis]), dtype=np.int64)
+    for index, base in enumerate(bases):
+        count[index] = np.count_nonzero(alignment == base, axis=axis)
+    return bases, count
+
+
+def count_difference(count: np.array, rows: int) -> np.array:
+    """
+    Given count of bases (from count_column), return number of sequence pairs
+    that have different bases in each column, i.e., (n^2 - sum(count^2)) / 2.
+    Args:
+        count: np.array, (bases, columns)
+        rows: rows number
+    Returns:
+        difference: np.array, (columns, )
+    """
+    return (rows * rows - np.sum(count * count, axis=0)) // 2
+
+
+def get_gc_table(ignore_ambiguous=True) -> np.array:
+    """
+    GC value of each code.
+    If not ignore_ambiguous, ambiguous bases having G or C count as
+    1/(number of bases), i.e., BDVH = 1/3, MYKR = 1/2, N = 1/4, except S = 1.
+    W (A/T) has no G or C thus is always 0. Since "X" and "?" share the code
+    of "N", they also count as 1/4 (they were 0 before the bitmask
+    encoding). If ignore_ambiguous, only G and C count.
+    Args:
+        ignore_ambiguous: count ambiguous bases or not
+    Returns:
+        table: np.array, (CODES, )
+    """
+    table = np.zeros(CODES, dtype=np.float64)
+    table[[G, C]] = 1
+    if not ignore_ambiguous:
+        code = np.arange(CODES)
+        ambiguous = (code & (G | C) != 0) & (BIT_COUNT > 1)
+        table[ambiguous] = 1 / BIT_COUNT[ambiguous]
+        table[G | C] = 1
+    return table
+
+
 def remove_gap(alignment: np.array, silence=False) -> (np.array, np.array):
     """
     Split alignment into with_gap and without_gap.
@@ -218,9 +392,8 @@ def remove_gap(alignment: np.array, silence=False) -> (np.array, np.array):
         no_gap_columns: without gap
         gap_columns: columns having gaps
     """
-    gap = b'-'
     # axis 0 for column
-    have_gap = np.any(alignment==gap, axis=0)
+    have_gap = np.any(alignment == GAP, axis=0)
     gap_columns = alignment[:, have_gap]
     no_gap_columns = alignment[:, ~have_gap]
     n_columns = alignment.shape[1]
@@ -256,6 +429,7 @@ def gc_ratio(alignment: np.array, ignore_ambiguous=True) -> (
         float, np.array):
     """
     Get GC ratio of total alignment and each sequence.
+    Gaps are not counted in total.
     Args:
         alignment: np.array
         ignore_ambiguous: count ambiguous bases or not
@@ -263,31 +437,81 @@ def gc_ratio(alignment: np.array, ignore_ambiguous=True) -> (
         total_gc: gc value
         gc_array: np.array of gc value for each row(sequence)
     """
-    def get_gc_ratio(row: np.array, ignore: bool):
-        # if True, do not count ambiguous bases as GC, but count them in total
-        # BDVH = 1/3 GC
-        # MSYKRS = 1/2 GC
-        gc = 0
-        count_ = np.unique(row, return_counts=True)
-        count = dict(zip(count_[0], count_[1]))
-        for base in (b'G', b'C'):
-            gc += count.get(base, 0)
-        if not ignore:
-            gc += count.get(b'N', 0) / 4
-            for ambiguous_base in (b'B', b'D', b'V', b'H'):
-                gc += count.get(ambiguous_base, 0) / 3
-            for ambiguous_base in (b'M', b'S', b'Y', b'K', b'R', b'S'):
-                gc += count.get(ambiguous_base, 0) / 2
-        return gc / (rows*columns-count.get(b'-', 0))
-
     rows, columns = alignment.shape
-    total_gc = get_gc_ratio(alignment, ignore_ambiguous)
-    gc_array = np.fromiter(
-        [get_gc_ratio(row, ignore_ambiguous) for row in alignment],
-        dtype=np.float)
+    # if True, do not count ambiguous bases as GC, but count them in total
+    bases, count = count_column(alignment, axis=1)
+    gc = get_gc_table(ignore_ambiguous)[bases] @ count
+    gap = np.zeros(rows, dtype=np.int64)
+    if GAP in bases:
+        gap = count[np.flatnonzero(bases == GAP)[0]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_gc = np.sum(gc) / (rows*columns-np.sum(gap))
+        gc_array = gc / (columns-gap)
     return total_gc, gc_array
 
 
+def get_hash_key(columns: int) -> np.array:
+    """
+    Random 64-bit coefficients for hash_rows(), two for each column.
+    Use fixed seed to get same keys in different runs.
+    Args:
+        columns: columns number
+    Returns:
+        key: np.array, (columns, 2), uint64
+    """
+    random = np.random.RandomState(0)
+    key = random.randint(0, 2**64, size=(columns, 2), dtype=np.uint64)
+    return key | np.uint64(1)
+
+
+def hash_rows(alignment: np.array, key: np.array) -> np.array:
+    """
+    Hash each row (sequence) of alignment into 128-bit digest, i.e., two
+    random linear combinations of bases modulo 2^64.
+    Because the digest is the sum of each column's value, digest of a new
+    window could be updated from the old one by only adding and subtracting
+    the changed columns.
+    Args:
+        alignment: np.array
+        key: np.array, (columns, 2), from get_hash_key()
+    Returns:
+        digest: np.array, (rows, 2), uint64
+    """
+    # limit memory usage of temporary uint64 array
+    chunk = 4096
+    rows, columns = alignment.shape
+    digest = np.zeros((rows, 2), dtype=np.uint64)
+    for i in range(0, columns, chunk):
+        digest += alignment[:, i:i+chunk].astype(np.uint64) @ key[i:i+chunk]
+    return digest
+
+
+def count_digest(digest: np.array) -> np.array:
+    """
+    Count each unique digest, like np.unique(alignment, axis=0) but only sort
+    16 bytes for each row.
+    Args:
+        digest: np.array, (rows, 2), from hash_rows()
+    Returns:
+        count: np.array, count of each unique sequence
+    """
+    digest = np.ascontiguousarray(digest).view(np.dtype((np.void, 16)))
+    item, count = np.unique(digest.ravel(), return_counts=True)
+    return count
+
+
+def count_haplotype(alignment: np.array) -> np.array:
+    """
+    Count each unique sequence of alignment by hashing.
+    Args:
+        alignment: np.array
+    Returns:
+        count: np.array, count of each unique sequence
+    """
+    rows, columns = alignment.shape
+    return count_digest(hash_rows(alignment, get_hash_key(columns)))
+
+
 def normalized_entropy(count: np.array, rows: int) -> float:
     """
     Calculate normalized entropy.
@@ -311,6 +535,9 @@ def normalized_entropy(count: np.array, rows: int) -> float:
 def nucleotide_diversity(alignment: np.array) -> float:
     """
     Nucleotide diversity (pi)
+    Instead of comparing every pair of sequences, use count of each base in
+    every column. For one column, number of pairs with different bases is
+    (n^2 - sum(count^2)) / 2.
     Args:
         alignment: np.array
     Returns:
@@ -319,15 +546,305 @@ def nucleotide_diversity(alignment: np.array) -> float:
     rows, columns = alignment.shape
     m = columns
     n = rows
-    sum_d_ij = 0
-    for i in range(n):
-        d_ij = np.sum(alignment[i] != alignment[(i + 1):])
-        sum_d_ij += d_ij
+    if n < 2 or m == 0:
+        return 0
+    bases, count = count_column(alignment)
+    sum_d_ij = int(np.sum(count_difference(count, n)))
     pi = (2 / (n * (n - 1)) * sum_d_ij) / m
     # pi should > 0, use max()
     return max(0, pi)
 
 
+class TreeCache:
+    """
+    Persistent cache of phylogenetic diversity results.
+    Key is the digest of tree options and bytes of the alignment, thus same
+    alignment (e.g., same window in different runs or conserved region)
+    only build tree once.
+    Saved as json in third_party folder. If the cache is too large, least
+    recently used results are removed.
+    """
+    __slots__ = ('filename', 'max_size', 'hits', 'misses', '_data', '_lock',
+                 '_changed')
+
+    def __init__(self, filename=None, max_size=100000):
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self._changed = False
+        if filename is not None and filename.exists():
+            try:
+                with open(filename, 'r', encoding='utf-8') as _:
+                    self._data.update(json.load(_))
+            except Exception:
+                log.debug(f'Bad tree cache {filename}, ignore it.')
+
+    @staticmethod
+    def get_key(alignment: np.array, option: str) -> str:
+        """
+        Args:
+            alignment: np.array
+            option: options of tree building
+        Returns:
+            key: hex digest
+        """
+        digest = blake2b(option.encode('utf-8'), digest_size=20)
+        digest.update(np.array(alignment.shape, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(alignment).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Return cached result or None.
+        """
+        with self._lock:
+            value = self._data.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+        return tuple(value)
+
+    def put(self, key: str, value: tuple) -> None:
+        with self._lock:
+            self._data[key] = [float(i) for i in value]
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._changed = True
+        return
+
+    def save(self) -> None:
+        """
+        Write to disk if changed.
+        """
+        with self._lock:
+            if self.filename is None or not self._changed:
+                return
+            tmp_file = self.filename.with_suffix('.tmp')
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as _:
+                    json.dump(self._data, _)
+                tmp_file.replace(self.filename)
+                self._changed = False
+            except Exception:
+                log.debug(f'Failed to save tree cache {self.filename}.')
+        log.debug(f'Tree cache: {self.hits} hits, {self.misses} misses.')
+        return
+
+
+def get_tree_cache() -> TreeCache:
+    """
+    Get the tree cache, only load once per process.
+    Returns:
+        tree_cache: TreeCache
+    """
+    global _tree_cache
+    if _tree_cache is None:
+        third_party_ok, third_party = utils.get_third_party()
+        if third_party_ok:
+            _tree_cache = TreeCache(third_party / TREE_CACHE_FILE)
+        else:
+            _tree_cache = TreeCache()
+    return _tree_cache
+
+
+def build_iqtree(alignment: np.array, tmp: Path, iqtree: str) -> str:
+    """
+    Run IQ-TREE and return the tree in newick format.
+    Each run use its own temporary folder and only one thread, thus could be
+    called in parallel. The tree is not parsed here because Phylo is
+    recursive and worker threads have much smaller stack than the main
+    thread, see parse_tree().
+    Args:
+        alignment: np.array
+        tmp: tmp folder
+        iqtree: iqtree path
+    Returns:
+        newick: tree string, empty if IQ-TREE failed
+    """
+    newick = ''
+    rows, columns = alignment.shape
+    tmp_folder = Path(mkdtemp(prefix=f'{columns}-', dir=tmp))
+    aln_file = tmp_folder / f'{columns}.tmp'
+    array_to_fasta(alignment, aln_file)
+    with open(devnull, 'w', encoding='utf-8') as out:
+        run_ = run(f'{iqtree} -s {aln_file} {IQTREE_OPTION} -redo -nt 1',
+                   stdout=out, stderr=out, shell=True)
+        # just return 0 if there is error
+    if run_.returncode != 0:
+        log.debug('Too much gap in the alignment.')
+    else:
+        with open(str(aln_file)+'.treefile', 'r', encoding='utf-8') as _:
+            newick = _.read()
+    rmtree(tmp_folder, ignore_errors=True)
+    return newick
+
+
+def parse_tree(newick: str) -> tuple:
+    """
+    Calculate the phylogenetic diversity from the tree.
+    Should be called in the main thread, and the caller should ensure the
+    recursion limit is enough for parsing the tree.
+    Args:
+        newick: tree string from build_iqtree()
+    Returns:
+        same as phylogenetic_diversity()
+    """
+    pd = 0.0
+    pd_stem = 0.0
+    pd_stem_sd = 0.0
+    pd_terminal = 0.0
+    pd_terminal_sd = 0.0
+    tree_res = 0.0
+    if not newick:
+        return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
+    tree = Phylo.read(StringIO(newick), 'newick')
+    try:
+        # skip the first empty node
+        internals = tree.get_nonterminals()[1:]
+        terminals = tree.get_terminals()
+        # may be zero
+        n_terminals = max(1, len(terminals))
+        pd = tree.total_branch_length() / n_terminals
+        pd_stem = sum([i.branch_length for i in internals]) / n_terminals
+        pd_stem_sd = np.std([i.branch_length for i in internals]) / n_terminals
+        pd_terminal = sum([i.branch_length for i in terminals]) / n_terminals
+        pd_terminal_sd = np.std([i.branch_length for i in terminals]) / n_terminals
+        tree_res = len(internals) / n_terminals
+    except Exception:
+        log.info('Bad phylogenetic tree.')
+    return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
+
+
+def run_iqtree(alignment: np.array, tmp: Path, iqtree: str) -> tuple:
+    """
+    Run IQ-TREE and calculate the phylogenetic diversity in current thread.
+    The caller should ensure the recursion limit is enough for parsing the
+    tree.
+    Args:
+        alignment: np.array
+        tmp: tmp folder
+        iqtree: iqtree path
+    Returns:
+        same as phylogenetic_diversity()
+    """
+    return parse_tree(build_iqtree(alignment, tmp, iqtree))
+
+
+def get_distance_matrix(alignment: np.array) -> np.array:
+    """
+    Kimura 2-parameter distance of each pair of sequences.
+    Gaps and ambiguous bases were ignored pairwise.
+    Use matrix multiplication of one-hot arrays to count transitions and
+    transversions of all pairs at once.
+    Args:
+        alignment: np.array
+    Returns:
+        distance: np.array, (rows, rows)
+    """
+    a, g, c, t = [(alignment == base).astype(np.float64) for base in
+                  (A, G, C, T)]
+    valid = a + g + c + t
+    length = valid @ valid.T
+    same = a @ a.T + g @ g.T + c @ c.T + t @ t.T
+    # A<->G, C<->T
+    transition = a @ g.T + g @ a.T + c @ t.T + t @ c.T
+    transversion = length - same - transition
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = transition / length
+        q = transversion / length
+        distance = (-0.5 * np.log(1 - 2*p - q) - 0.25 * np.log(1 - 2*q))
+    # saturated, or no site could be compared
+    bad = ~np.isfinite(distance)
+    if bad.any():
+        if bad.all():
+            distance[bad] = 0
+        else:
+            distance[bad] = distance[~bad].max()
+    distance = np.maximum(distance, 0)
+    np.fill_diagonal(distance, 0)
+    return distance
+
+
+def neighbor_joining(distance: np.array) -> (np.array, np.array):
+    """
+    Neighbor-joining, only return branch lengths.
+    Negative branch lengths were set to 0.
+    Args:
+        distance: np.array, (rows, rows), rows >= 3
+    Returns:
+        terminal: np.array, branch length of each terminal
+        internal: np.array, branch length of each internal node except the
+        root
+    """
+    d = np.array(distance, dtype=np.float64)
+    n = len(d)
+    # id < n for terminal
+    nodes = list(range(n))
+    new_id = n
+    terminal = np.zeros(n, dtype=np.float64)
+    internal = []
+
+    def add_branch(node, length):
+        if node < n:
+            terminal[node] = max(0, length)
+        else:
+            internal.append(max(0, length))
+
+    while len(nodes) > 3:
+        active = len(nodes)
+        r = d.sum(axis=1)
+        q = (active - 2) * d - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = divmod(int(np.argmin(q)), active)
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (active - 2))
+        add_branch(nodes[i], length_i)
+        add_branch(nodes[j], d[i, j] - length_i)
+        # replace i with new node, then remove j
+        new = 0.5 * (d[i] + d[j] - d[i, j])
+        d[i] = new
+        d[:, i] = new
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        nodes[i] = new_id
+        del nodes[j]
+        new_id += 1
+    # the root connects the last three nodes
+    add_branch(nodes[0], (d[0, 1] + d[0, 2] - d[1, 2]) / 2)
+    add_branch(nodes[1], (d[0, 1] + d[1, 2] - d[0, 2]) / 2)
+    add_branch(nodes[2], (d[0, 2] + d[1, 2] - d[0, 1]) / 2)
+    return terminal, np.array(internal, dtype=np.float64)
+
+
+def run_nj(alignment: np.array) -> tuple:
+    """
+    Calculate the phylogenetic diversity with neighbor-joining tree of K2P
+    distance in-process, much faster than run_iqtree().
+    Like "-czb" of IQ-TREE, internal branches shorter than MIN_BRANCH were
+    collapsed.
+    Args:
+        alignment: np.array, rows >= 4
+    Returns:
+        same as phylogenetic_diversity()
+    """
+    rows, columns = alignment.shape
+    terminal, internal = neighbor_joining(get_distance_matrix(alignment))
+    internal = internal[internal > MIN_BRANCH]
+    n_terminals = max(1, len(terminal))
+    pd = (terminal.sum() + internal.sum()) / n_terminals
+    pd_stem = internal.sum() / n_terminals
+    pd_stem_sd = internal.std() / n_terminals if len(internal) else 0.0
+    pd_terminal = terminal.sum() / n_terminals
+    pd_terminal_sd = terminal.std() / n_terminals
+    tree_res = len(internal) / n_terminals
+    return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
+
+
 def phylogenetic_diversity(alignment: np.array, tmp: Path) -> (float, float,
                                                                float, float):
     """
@@ -344,49 +861,26 @@ def phylogenetic_diversity(alignment: np.array, tmp: Path) -> (float, float,
         pd_terminal_sd: standard deviation
         tree_res: tree resolution
     """
-    pd = 0.0
-    pd_stem = 0.0
-    pd_stem_sd = 0.0
-    pd_terminal = 0.0
-    pd_terminal_sd = 0.0
-    tree_res = 0.0
+    empty = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
     rows, columns = alignment.shape
     if rows < 4:
         log.debug('Too few sequences.')
-        return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
-    old_max_recursion = sys.getrecursionlimit()
-    sys.setrecursionlimit(max(rows+10, old_max_recursion))
-    aln_file = tmp / f'{columns}.tmp'
-    array_to_fasta(alignment, aln_file)
+        return empty
     _, iqtree = utils.get_iqtree()
     if not _:
         log.critical('Cannot find iqtree.')
-        return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
-    with open(devnull, 'w', encoding='utf-8') as out:
-        run_ = run(f'{iqtree} -s {aln_file} -m HKY -fast -czb -redo',
-                   stdout=out, stderr=out, shell=True)
-        # just return 0 if there is error
-    if run_.returncode != 0:
-        log.debug('Too much gap in the alignment.')
-    else:
-        tree = Phylo.read(str(aln_file)+'.treefile', 'newick')
-        try:
-            # skip the first empty node
-            internals = tree.get_nonterminals()[1:]
-            terminals = tree.get_terminals()
-            # may be zero
-            n_terminals = max(1, len(terminals))
-            pd = tree.total_branch_length() / n_terminals
-            pd_stem = sum([i.branch_length for i in internals]) / n_terminals
-            pd_stem_sd = np.std([i.branch_length for i in internals]) / n_terminals
-            pd_terminal = sum([i.branch_length for i in terminals]) / n_terminals
-            pd_terminal_sd = np.std([i.branch_length for i in terminals]) / n_terminals
-            tree_res = len(internals) / n_terminals
-        except Exception:
-            log.info('Bad phylogenetic tree.')
-    utils.clean_tmp(aln_file)
+        return empty
+    tree_cache = get_tree_cache()
+    key = tree_cache.get_key(alignment, IQTREE_OPTION)
+    result = tree_cache.get(key)
+    if result is not None:
+        return result
+    old_max_recursion = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(rows+10, old_max_recursion))
+    result = run_iqtree(alignment, tmp, iqtree)
     sys.setrecursionlimit(old_max_recursion)
-    return pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res
+    tree_cache.put(key, result)
+    return result
 
 
 class Variance(namedtuple('Variance',
@@ -425,8 +919,8 @@ def get_resolution(alignment: np.array, tmp: Path,
     # index error
     if columns == 0:
         return Variance(), gc_array
-    gap_ratio = len(alignment[alignment == b'-']) / total
-    item, count = np.unique(alignment, return_counts=True, axis=0)
+    gap_ratio = np.count_nonzero(alignment == GAP) / total
+    count = count_haplotype(alignment)
     observed_res = len(count) / rows
     # normalized entropy
     entropy = normalized_entropy(count, rows)
@@ -440,6 +934,228 @@ def get_resolution(alignment: np.array, tmp: Path,
     return variance, gc_array
 
 
+class SlidingWindow:
+    """
+    Per-column statistics of an alignment for the sliding-window scan.
+    Gap count, GC value and number of different pairs of each column were
+    calculated once, then their cumulative sums give Gap_Ratio, Total_GC and
+    Pi of any window in O(1).
+    If ignore_gap, columns having gaps are excluded from every window.
+    """
+    __slots__ = ('alignment', 'size', 'step', 'rows', 'columns', 'keep',
+                 '_kept', '_gap', '_gc', '_difference', '_key', '_digest',
+                 '_start', '_end')
+
+    def __init__(self, alignment: np.array, size: int, step: int,
+                 ignore_ambiguous=True, ignore_gap=False):
+        self.alignment = alignment
+        self.size = size
+        self.step = step
+        self.rows, self.columns = alignment.shape
+        bases, count = count_column(alignment)
+        gap = np.zeros(self.columns, dtype=np.int64)
+        if GAP in bases:
+            gap = count[np.flatnonzero(bases == GAP)[0]]
+        if ignore_gap:
+            self.keep = gap == 0
+        else:
+            self.keep = np.ones(self.columns, dtype=np.bool_)
+        gc = get_gc_table(ignore_ambiguous)[bases] @ count
+        difference = count_difference(count, self.rows)
+
+        def cumsum(x):
+            # start with 0, exclude removed columns
+            return np.concatenate(([0], np.cumsum(x * self.keep)))
+
+        self._kept = cumsum(np.ones(self.columns, dtype=np.int64))
+        self._gap = cumsum(gap)
+        self._gc = cumsum(gc)
+        self._difference = cumsum(difference)
+        # removed columns do not affect digest
+        self._key = get_hash_key(self.columns) * self.keep[:, None].astype(
+            np.uint64)
+        self._digest = None
+        self._start = 0
+        self._end = 0
+
+    def windows(self):
+        """
+        Yield (start, end) of each window, end is excluded.
+        """
+        for start in range(0, self.columns, self.step):
+            yield start, min(start + self.size, self.columns)
+
+    def get_alignment(self, start: int, end: int) -> np.array:
+        """
+        Return alignment of the window, excluding removed columns.
+        """
+        subalign = self.alignment[:, start:end]
+        keep = self.keep[start:end]
+        if not keep.all():
+            subalign = subalign[:, keep]
+        return subalign
+
+    def count_haplotype(self, start: int, end: int) -> np.array:
+        """
+        Count each unique sequence in the window.
+        If windows move forward, digest of each sequence is updated by
+        columns that leave or enter the window, instead of hashing the whole
+        window again.
+        """
+        if (self._digest is None or start < self._start or end < self._end
+                or start >= self._end):
+            self._digest = hash_rows(self.alignment[:, start:end],
+                                     self._key[start:end])
+        else:
+            self._digest -= hash_rows(self.alignment[:, self._start:start],
+                                      self._key[self._start:start])
+            self._digest += hash_rows(self.alignment[:, self._end:end],
+                                      self._key[self._end:end])
+        self._start = start
+        self._end = end
+        return count_digest(self._digest)
+
+    def get_columns(self, start: int, end: int) -> int:
+        return int(self._kept[end] - self._kept[start])
+
+    def gap_ratio(self, start: int, end: int) -> float:
+        total = self.rows * self.get_columns(start, end)
+        if total == 0:
+            return 0
+        return (self._gap[end] - self._gap[start]) / total
+
+    def gc_ratio(self, start: int, end: int) -> float:
+        total = (self.rows * self.get_columns(start, end)
+                 - (self._gap[end] - self._gap[start]))
+        if total == 0:
+            return 0
+        return (self._gc[end] - self._gc[start]) / total
+
+    def pi(self, start: int, end: int) -> float:
+        n = self.rows
+        m = self.get_columns(start, end)
+        if n < 2 or m == 0:
+            return 0
+        sum_d_ij = self._difference[end] - self._difference[start]
+        pi = (2 / (n * (n - 1)) * sum_d_ij) / m
+        return max(0, pi)
+
+
+def get_window_resolution(window: SlidingWindow, start: int, end: int,
+                          tmp: Path, phylogenetic=True) -> Variance:
+    """
+    Same as get_resolution(), but use statistics of SlidingWindow and skip
+    GC ratio of each sequence.
+    Args:
+        window: SlidingWindow
+        start: window start
+        end: window end, excluded
+        tmp: tmp folder
+        phylogenetic: calculate phylogenetic diversity or not, see
+        window_phylogenetic_diversity()
+    Returns:
+        variance: Variance
+    """
+    subalign = window.get_alignment(start, end)
+    rows, columns = subalign.shape
+    if columns == 0:
+        return Variance()
+    count = window.count_haplotype(start, end)
+    observed_res = len(count) / rows
+    entropy = normalized_entropy(count, rows)
+    if phylogenetic:
+        (pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd,
+         tree_res) = phylogenetic_diversity(subalign, tmp)
+    else:
+        pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd, tree_res = (
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    variance = Variance(rows, columns, window.gap_ratio(start, end),
+                        observed_res, entropy, window.pi(start, end),
+                        pd, pd_stem, pd_stem_sd, pd_terminal, pd_terminal_sd,
+                        tree_res, window.gc_ratio(start, end))
+    return variance
+
+
+def window_phylogenetic_diversity(window: SlidingWindow, sliding: list,
+                                  tmp: Path, threads: int,
+                                  engine='iqtree') -> list:
+    """
+    Calculate phylogenetic diversity of each window in parallel.
+    Each IQ-TREE job uses one thread and at most "threads" jobs run at the
+    same time. Results are put back in the order of windows.
+    Args:
+        window: SlidingWindow
+        sliding: list of Variance from get_window_resolution(), without
+        phylogenetic diversity
+        tmp: tmp folder
+        threads: maximum number of IQ-TREE jobs
+        engine: 'iqtree' or 'nj', see run_nj()
+    Returns:
+        sliding: list of Variance
+    """
+    fields = ('PD', 'PD_stem', 'PD_stem_SD', 'PD_terminal', 'PD_terminal_SD',
+              'Tree_Res')
+    if window.rows < 4:
+        log.debug('Too few sequences.')
+        return sliding
+    if engine == 'nj':
+        option = NJ_OPTION
+    else:
+        option = IQTREE_OPTION
+        _, iqtree = utils.get_iqtree()
+        if not _:
+            log.critical('Cannot find iqtree.')
+            return sliding
+    tree_cache = get_tree_cache()
+    # key: [start, end], identical windows only build tree once
+    todo = dict()
+    # index: result, empty windows were skipped
+    window_results = dict()
+    # index: key, for windows not in the cache
+    window_keys = dict()
+    for index, (start, end) in enumerate(window.windows()):
+        if sliding[index].Length == 0:
+            continue
+        key = tree_cache.get_key(window.get_alignment(start, end), option)
+        if key in todo:
+            window_keys[index] = key
+            continue
+        result = tree_cache.get(key)
+        if result is None:
+            todo[key] = (start, end)
+            window_keys[index] = key
+        else:
+            window_results[index] = result
+
+    def job(start_end):
+        start, end = start_end
+        if engine == 'nj':
+            return run_nj(window.get_alignment(start, end))
+        return build_iqtree(window.get_alignment(start, end), tmp, iqtree)
+
+    threads = max(1, threads)
+    log.info(f'Build trees of {len(todo)} windows with {threads} threads '
+             f'({len(window_results)} windows were cached).')
+    old_max_recursion = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(window.rows+10, old_max_recursion))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # map keeps the order, trees are parsed in the main thread
+        results = list(pool.map(job, todo.values()))
+    if engine != 'nj':
+        results = [parse_tree(i) for i in results]
+    sys.setrecursionlimit(old_max_recursion)
+    computed = dict(zip(todo.keys(), results))
+    for key, result in computed.items():
+        tree_cache.put(key, result)
+    for index, key in window_keys.items():
+        window_results[index] = computed[key]
+    sliding = list(sliding)
+    for index, result in window_results.items():
+        sliding[index] = sliding[index]._replace(**dict(zip(fields, result)))
+    tree_cache.save()
+    return sliding
+
+
 def output_sliding(sliding: list, name: str, out: Path,
                    size: int, step: int) -> (Path, Path):
     if len(sliding) == 0:
@@ -510,7 +1226,7 @@ def evaluate(aln: Path, arg) -> tuple:
         sliding: list of Variance
     """
     sliding = []
-    name, alignment = fasta_to_array(aln)
+    name, alignment = fasta_to_array(aln, arg._tmp/(aln.name+'.npy'))
     if name is None:
         log.info(f'Invalid fasta file {aln}.')
         return None, None, None
@@ -527,14 +1243,14 @@ def evaluate(aln: Path, arg) -> tuple:
         pass
     else:
         # sliding window
-        for i in range(0, columns, arg.step):
-            # view, not copy
-            subalign = alignment[:, i:i+arg.size]
-            if arg.ignore_gap:
-                subalign, gap_subalign = remove_gap(alignment, silence=True)
-            variance, sub_gc_array = get_resolution(subalign, arg._tmp,
-                                                    arg.ignore_ambiguous_base)
+        window = SlidingWindow(alignment, arg.size, arg.step,
+                               arg.ignore_ambiguous_base, arg.ignore_gap)
+        for start, end in window.windows():
+            variance = get_window_resolution(window, start, end, arg._tmp,
+                                             phylogenetic=False)
             sliding.append(variance)
+        sliding = window_phylogenetic_diversity(window, sliding, arg._tmp,
+                                                arg.threads, arg.tree_engine)
     return summary, gc_array, sliding
 
 
@@ -569,6 +1285,7 @@ def evaluate_main():
             out.write(aln.stem+','+str(summary)+'\n')
         if not arg.quick:
             output_sliding(sliding, aln.stem, arg._evaluate, arg.size, arg.step)
+    get_tree_cache().save()
     log.info(f'Evaluation results could be found in {evaluation_result}')
     log.info('Evaluate module finished.')
     # for i in aligned:
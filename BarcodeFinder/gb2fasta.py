@@ -3,15 +3,29 @@
 import argparse
 import json
 import logging
+import mmap
+import pickle
+import re
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import copy
+from functools import lru_cache
+from hashlib import blake2b
 from io import StringIO
+from os import cpu_count, scandir
 from pathlib import Path
+from shutil import copyfileobj, rmtree
 from pkg_resources import resource_filename
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
 
 from Bio import Entrez, SeqIO
-from Bio.SeqFeature import SeqFeature, FeatureLocation
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
+from Bio.SeqFeature import BeforePosition, AfterPosition
+from Bio.SeqRecord import SeqRecord
+from Bio.Data.IUPACData import ambiguous_dna_complement
 
 from BarcodeFinder import utils
 
@@ -27,22 +41,49 @@ except ImportError:
     pass
 
 
-# load data
-with open(resource_filename('BarcodeFinder', 'data/superkingdoms.csv'),
-          'r') as _:
-    SUPERKINGDOMS = set(_.read().split(','))
-with open(resource_filename('BarcodeFinder', 'data/kingdoms.csv'),
-          'r') as _:
-    KINGDOMS = set(_.read().split(','))
-with open(resource_filename('BarcodeFinder', 'data/phyla.csv'),
-          'r') as _:
-    PHYLA = set(_.read().split(','))
-with open(resource_filename('BarcodeFinder', 'data/classes.csv'),
-          'r') as _:
-    CLASSES = set(_.read().split(','))
-with open(resource_filename('BarcodeFinder', 'data/animal_orders.csv'),
-          'r') as _:
-    ANIMAL_ORDERS = set(_.read().split(','))
+# taxonomy lists from NCBI, compiled by get_taxon_table()
+TAXON_DATA = ('superkingdoms.csv', 'kingdoms.csv', 'phyla.csv',
+              'classes.csv', 'animal_orders.csv')
+TAXON_TABLE_FILE = 'taxon_table.pickle'
+# index of ranks in result of get_taxon()
+KINGDOM, PHYLUM, CLASS, ORDER, FAMILY = range(5)
+_TAXON_TABLE = None
+
+# features used by divide(), others were skipped by parse_gb_record()
+FEATURE_TYPES = {'source', 'gene', 'CDS', 'tRNA', 'rRNA', 'misc_feature',
+                 'misc_RNA'}
+# qualifiers used by divide(), others were skipped by parse_qualifiers()
+QUALIFIERS = {'gene', 'product', 'locus_tag', 'note', 'organism',
+              'specimen_voucher', 'isolate'}
+# feature key starts from column 6, location and qualifiers from column 22
+FEATURE_START = re.compile(r'^ {5}(\S+) +(\S*)$', re.M)
+QUALIFIER_START = '\n' + ' '*21 + '/'
+# quoted value may take several lines and have escaped quotes ("")
+QUALIFIER = re.compile(r'\n {21}/([^=\n]+)(?:=("[^"]*(?:""[^"]*)*"|[^\n]*))?')
+# Entrez accept at most 3 requests per second without API key
+ENTREZ_RATE = 3
+# number of efetch requests running at the same time
+DOWNLOAD_JOBS = 3
+# although Bio.Entrez has max_tries, current code could handle error clearly
+RETRY_MAX = 10
+MANIFEST_FILE = 'manifest.json'
+VERSION_LINE = re.compile(rb'^VERSION +(\S+)', re.M)
+ACCESSION_LINE = re.compile(rb'^ACCESSION +(\S+)', re.M)
+# genbank files larger than it were divided in parallel, in batches of
+# about this size
+BATCH_SIZE = 16 * 1024 * 1024
+# index of records was saved as "{genbank file}.index.json"
+INDEX_SUFFIX = '.index.json'
+# 1..100, <1..>100, 100
+SIMPLE_LOCATION = re.compile(r'(<?)(\d+)(?:\.\.(>?)(\d+))?$')
+# remove numbers and whitespace in ORIGIN
+SEQUENCE_DELETE = str.maketrans('', '', '0123456789 \t\r\n')
+# for reverse complement of location on minus strand, keep case
+COMPLEMENT = str.maketrans(
+    ''.join(ambiguous_dna_complement).upper() +
+    ''.join(ambiguous_dna_complement).lower(),
+    ''.join(ambiguous_dna_complement.values()).upper() +
+    ''.join(ambiguous_dna_complement.values()).lower())
 
 
 def parse_args(arg_str=None):
@@ -50,6 +91,8 @@ def parse_args(arg_str=None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     arg.add_argument('-gb', nargs='*', help='input filename')
     arg.add_argument('-out', help='output directory')
+    arg.add_argument('-threads', type=int, default=max(1, cpu_count()-1),
+                     help='number of threads')
     # trnK-matK
     arg.add_argument('-allow_mosaic_spacer', action='store_true',
                        help='allow mosaic spacer')
@@ -61,6 +104,10 @@ def parse_args(arg_str=None):
     # for primer
     arg.add_argument('-expand', type=int, default=0,
                      help='expand length of upstream/downstream')
+    arg.add_argument('-filter_gene', nargs='*',
+                     help='only divide records having these genes')
+    arg.add_argument('-filter_taxon', nargs='*',
+                     help='only divide records of these taxa')
     arg.add_argument('-max_name_len', default=100, type=int,
                      help='maximum length of feature name')
     # handle rps12
@@ -72,6 +119,8 @@ def parse_args(arg_str=None):
     arg.add_argument('-unique', choices=('longest', 'first', 'no'),
                      default='first',
                      help='method to remove redundant sequences')
+    arg.add_argument('-unique_seq', action='store_true',
+                     help='remove identical sequences of different species')
     query = arg.add_argument_group('Query')
     query.add_argument('-email', type=str,
                        help='email address for querying Genbank')
@@ -216,22 +265,403 @@ def init_arg(arg):
     return arg
 
 
+class RateLimiter:
+    """
+    Limit requests per second among threads.
+    """
+    __slots__ = ('interval', '_lock', '_next')
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._lock = Lock()
+        self._next = 0.0
+
+    def wait(self):
+        """
+        Block until next request is allowed.
+        """
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+
+def get_download_folder(arg, key: str) -> Path:
+    """
+    Folder for part files and manifest of the query. Same query with same
+    records use same folder, thus broken download could be resumed by next
+    run, even with different output folder.
+    Args:
+        arg: arguments
+        key: string to identify the query
+    Returns:
+        folder: Path
+    """
+    key = blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+    success, third_party = utils.get_third_party()
+    if success:
+        folder = third_party / 'download' / key
+    else:
+        folder = arg._tmp / 'download' / key
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def load_manifest(manifest_file: Path, query: str, count: int,
+                  ret_max: int) -> dict:
+    """
+    Load manifest of downloaded batches if it matches the query.
+    Args:
+        manifest_file: manifest json
+        query: query string
+        count: number of records to download
+        ret_max: number of records of each batch
+    Returns:
+        manifest: {'query': str, 'count': int, 'ret_max': int,
+                   'done': {ret_start: part filename},
+                   'failed': [ret_start of failed batches of last run]}
+    """
+    manifest = {'query': query, 'count': count, 'ret_max': ret_max,
+                'done': {}, 'failed': []}
+    if not manifest_file.exists():
+        return manifest
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as _:
+            old = json.load(_)
+    except Exception:
+        log.debug(f'Bad manifest {manifest_file}, ignore it.')
+        return manifest
+    if all(old.get(i) == manifest[i] for i in ('query', 'count', 'ret_max')):
+        done = old.get('done', {})
+        # part files may be deleted
+        manifest['done'] = {i: done[i] for i in done
+                            if (manifest_file.parent/done[i]).exists()}
+    return manifest
+
+
+def save_manifest(manifest: dict, manifest_file: Path):
+    """
+    Write manifest atomically.
+    """
+    tmp_file = manifest_file.with_suffix('.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as _:
+        json.dump(manifest, _, indent=4, sort_keys=True)
+    tmp_file.replace(manifest_file)
+
+
+def fetch_batch(query_handle, ret_start: int, ret_max: int, part: Path,
+                limiter: RateLimiter, retry_max: int) -> bool:
+    """
+    Download one batch of records into part file.
+    Because of connection to Genbank website is not stable, it will retry if
+    failed.
+    Args:
+        query_handle: result of esearch
+        ret_start: start index
+        ret_max: number of records
+        part: part file
+        limiter: RateLimiter
+        retry_max: maximum retry times
+    Returns:
+        success: bool
+    """
+    retry = 0
+    while True:
+        limiter.wait()
+        try:
+            data = Entrez.efetch(db='nuccore',
+                                 webenv=query_handle['WebEnv'],
+                                 query_key=query_handle['QueryKey'],
+                                 rettype='gb',
+                                 retmode='text',
+                                 retstart=ret_start,
+                                 retmax=ret_max).read()
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            # incomplete response or error message
+            if not data.rstrip().endswith('//'):
+                raise ValueError('Incomplete data')
+            tmp_part = part.with_suffix('.tmp')
+            with open(tmp_part, 'w', encoding='utf-8') as out:
+                out.write(data)
+            tmp_part.replace(part)
+            return True
+        # just retry if connection failed
+        # IOError could not handle all types of failure
+        except Exception:
+            sleep(1)
+            if retry < retry_max:
+                log.warning(f'Failed on download {ret_start}--'
+                            f'{ret_start+ret_max}. Retrying...')
+                retry += 1
+            else:
+                log.critical(f'Too much failure ({retry_max} times) on '
+                             f'{ret_start}--{ret_start+ret_max}.')
+                return False
+
+
+class GenBankCache:
+    """
+    Local store of genbank records downloaded before, keyed by
+    accession.version, thus newer version of a record is a new key.
+    Records were appended to one file, with a json index of
+    {accession.version: [offset, length]}.
+    """
+    __slots__ = ('folder', 'data_file', 'index_file', '_index')
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.data_file = folder / 'records.gb'
+        self.index_file = folder / 'index.json'
+        self._index = {}
+        if self.index_file.exists() and self.data_file.exists():
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as _:
+                    index = json.load(_)
+            except Exception:
+                log.debug(f'Bad index {self.index_file}, ignore it.')
+                index = {}
+            size = self.data_file.stat().st_size
+            # drop records that were not written completely
+            self._index = {key: value for key, value in index.items()
+                           if value[0]+value[1] <= size}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @staticmethod
+    def get_key(data: bytes) -> str:
+        """
+        Get accession.version of a record.
+        If the record does not have "VERSION" line, use accession instead,
+        or the digest of the record if it does not have "ACCESSION" line
+        either, thus every record has a key.
+        Args:
+            data: bytes of the record
+        Returns:
+            key: accession.version, accession or digest
+        """
+        for pattern in (VERSION_LINE, ACCESSION_LINE):
+            match = pattern.search(data)
+            if match is not None:
+                return match.group(1).decode('utf-8')
+        return 'unknown-' + blake2b(data, digest_size=16).hexdigest()
+
+    def add(self, gbfile: Path) -> list:
+        """
+        Add records in the genbank file.
+        Args:
+            gbfile: genbank file
+        Returns:
+            keys: keys of records in the file, in order
+        """
+        keys = []
+        with open(self.data_file, 'ab') as out:
+            for start, data in scan_gb(gbfile):
+                key = self.get_key(data)
+                keys.append(key)
+                if key in self._index:
+                    continue
+                offset = out.tell()
+                out.write(data)
+                self._index[key] = [offset, len(data)]
+        return keys
+
+    def write(self, keys: list, output):
+        """
+        Write records of given keys to output handle (binary), in order.
+        Args:
+            keys: keys of records
+            output: handle
+        """
+        with open(self.data_file, 'rb') as data:
+            for key in keys:
+                offset, length = self._index[key]
+                data.seek(offset)
+                output.write(data.read(length))
+
+    def save(self):
+        tmp_file = self.index_file.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as _:
+            json.dump(self._index, _)
+        tmp_file.replace(self.index_file)
+
+
+def get_genbank_cache():
+    """
+    Return GenBankCache in third_party folder, or None if the folder is not
+    accessible.
+    """
+    success, third_party = utils.get_third_party()
+    if not success:
+        return None
+    folder = third_party / 'genbank'
+    folder.mkdir(exist_ok=True)
+    return GenBankCache(folder)
+
+
+def get_accessions(query_handle, count: int, limiter: RateLimiter,
+                   retry_max: int) -> list:
+    """
+    Get accession.version of records in query result, in order.
+    Args:
+        query_handle: result of esearch
+        count: number of records
+        limiter: RateLimiter
+        retry_max: maximum retry times
+    Returns:
+        accessions: list, empty if failed
+    """
+    accessions = []
+    ret_max = 10000
+    retry = 0
+    while len(accessions) < count:
+        limiter.wait()
+        try:
+            data = Entrez.efetch(db='nuccore',
+                                 webenv=query_handle['WebEnv'],
+                                 query_key=query_handle['QueryKey'],
+                                 rettype='acc',
+                                 retmode='text',
+                                 retstart=len(accessions),
+                                 retmax=min(ret_max,
+                                            count-len(accessions))).read()
+        except Exception:
+            sleep(1)
+            if retry < retry_max:
+                retry += 1
+                continue
+            log.warning('Failed to get accessions of records.')
+            return []
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        batch = data.split()
+        if not batch:
+            break
+        accessions.extend(batch)
+    return accessions[:count]
+
+
+def post_accessions(accessions: list, limiter: RateLimiter,
+                    retry_max: int):
+    """
+    Upload accessions to Entrez history server, thus they could be
+    downloaded in batches like the result of esearch.
+    Args:
+        accessions: list of accession.version
+        limiter: RateLimiter
+        retry_max: maximum retry times
+    Returns:
+        post_handle: result of epost, None if failed
+    """
+    retry = 0
+    while True:
+        limiter.wait()
+        try:
+            return Entrez.read(Entrez.epost(db='nuccore',
+                                            id=','.join(accessions)))
+        except Exception:
+            sleep(1)
+            if retry < retry_max:
+                log.warning('Failed on upload accessions. Retrying...')
+                retry += 1
+            else:
+                log.critical(f'Too much failure ({retry_max} times) on '
+                             f'upload accessions.')
+                return None
+
+
+def download_batches(query_handle, count: int, key: str, arg,
+                     limiter: RateLimiter, retry_max: int) -> tuple:
+    """
+    Download records in batches by several threads, each batch was written
+    into a part file, with a manifest recording finished batches. Batches
+    that still failed after retrying were recorded in the manifest and
+    skipped, run the same query again will only download the rest.
+    Args:
+        query_handle: result of esearch or epost
+        count: number of records
+        key: string to identify the query
+        arg: arguments
+        limiter: RateLimiter
+        retry_max: maximum retry times
+    Returns:
+        parts: list of part files of finished batches in order, None if all
+        batches failed
+        failed: number of failed batches
+    """
+    if count >= 1000:
+        ret_max = 1000
+    elif count >= 100:
+        ret_max = 100
+    elif count >= 10:
+        ret_max = 10
+    else:
+        ret_max = 1
+    folder = get_download_folder(arg, key)
+    manifest_file = folder / MANIFEST_FILE
+    manifest = load_manifest(manifest_file, key, count, ret_max)
+    batches = list(range(0, count, ret_max))
+    todo = [i for i in batches if str(i) not in manifest['done']]
+    if len(todo) != len(batches):
+        log.info(f'\tResume download from {folder}, '
+                 f'{len(batches)-len(todo)} of {len(batches)} batches '
+                 f'were downloaded.')
+    lock = Lock()
+
+    def fetch(ret_start):
+        log.info('\t{:d}--{:d}'.format(ret_start, ret_start + ret_max))
+        part = folder / f'{ret_start:09d}.gb'
+        success = fetch_batch(query_handle, ret_start, ret_max, part,
+                              limiter, retry_max)
+        with lock:
+            if success:
+                manifest['done'][str(ret_start)] = part.name
+            else:
+                manifest['failed'].append(ret_start)
+            save_manifest(manifest, manifest_file)
+        return success
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_JOBS) as pool:
+        failed = list(pool.map(fetch, todo)).count(False)
+    manifest['failed'].sort()
+    save_manifest(manifest, manifest_file)
+    # keep a copy next to Query.json
+    save_manifest(manifest, arg._tmp/'Download.json')
+    if failed != 0:
+        log.critical(f'{failed} of {len(batches)} batches failed, skip them.')
+        log.info('Run the same query again to download the rest.')
+    if failed == len(batches):
+        return None, failed
+    parts = [folder/manifest['done'][str(i)] for i in batches
+             if str(i) in manifest['done']]
+    return parts, failed
+
+
 def download(arg):
     """
     Download records from Genbank.
-    Because of connection to Genbank website is not stable (especially in
-    Asia), it will retry if failed. Ctrl+C to break.
+    Records downloaded before were kept in local cache, only records missing
+    in the cache (or with newer version) were downloaded.
+    Batches that kept failing were skipped, run the same query again will
+    only download the rest.
+    Ctrl+C to break.
     """
     TOO_MUCH = 50000
-    # although Bio.Entrez has max_tries, current code could handle error
-    # clearly
-    RETRY_MAX = 10
     if arg.email is None:
         Entrez.email = 'guest@example.com'
         log.info(f'\tEmail address for using Entrez missing, '
                  f'use {Entrez.email} instead.')
     else:
         Entrez.email = arg.email
+    # all requests share the rate limit
+    limiter = RateLimiter(ENTREZ_RATE)
+    limiter.wait()
     query_handle = Entrez.read(Entrez.esearch(db='nuccore', term=arg.query,
                                               usehistory='y'))
     count = int(query_handle['Count'])
@@ -248,8 +678,6 @@ def download(arg):
         if count > arg.seq_n:
             count = arg.seq_n
             log.info(f'\tDownload {arg.seq_n} records because of "-seq_n".')
-    log.info('\tDownloading...')
-    log.warning('\tMay be slow if connection is bad. Ctrl+C to quit.')
     name_words = []
     for i in (arg.taxon, arg.organelle, arg.gene):
         if i is not None and i not in ('both', 'ignore', 'no'):
@@ -259,90 +687,505 @@ def download(arg):
     else:
         name = 'sequence.gb'
     file_name = arg._gb / name
-    output = open(file_name, 'w', encoding='utf-8')
-    ret_start = 0
-    if count >= 1000:
-        ret_max = 1000
-    elif count >= 100:
-        ret_max = 100
-    elif count >= 10:
-        ret_max = 10
-    else:
-        ret_max = 1
-    retry = 0
-    while ret_start < count:
-        log.info('\t{:d}--{:d}'.format(ret_start, ret_start + ret_max))
-        # Entrez accept at most 3 times per second
-        # However, due to slow network, it's fine :)
-        try:
-            data = Entrez.efetch(db='nuccore',
-                                 webenv=query_handle['WebEnv'],
-                                 query_key=query_handle['QueryKey'],
-                                 rettype='gb',
-                                 retmode='text',
-                                 retstart=ret_start,
-                                 retmax=ret_max)
-            output.write(data.read())
-        # just retry if connection failed
-        # IOError could not handle all types of failure
-        except Exception:
-            sleep(1)
-            if retry <= RETRY_MAX:
-                log.warning('Failed on download. Retrying...')
-                retry += 1
-                continue
-            else:
-                log.critical(f'Too much failure ({RETRY_MAX} times).')
-                log.info('Abort download.')
-                return None
-        ret_start += ret_max
-    log.info('Download finished.')
     json_file = arg._tmp / 'Query.json'
     with open(json_file, 'w', encoding='utf-8') as _:
         json.dump(query_handle, _, indent=4, sort_keys=True)
     log.info(f'The query info was dumped into {json_file}')
+    cache = get_genbank_cache()
+    accessions = []
+    if cache is not None and len(cache) != 0:
+        accessions = get_accessions(query_handle, count, limiter, RETRY_MAX)
+    fetch_handle = None
+    if accessions:
+        missing = [i for i in accessions if i not in cache]
+        log.info(f'\t{count-len(missing)} records were found in local '
+                 f'cache.')
+        if missing:
+            fetch_handle = post_accessions(missing, limiter, RETRY_MAX)
+            if fetch_handle is None:
+                log.warning('\tDownload all records of the query instead.')
+                accessions = []
+    if accessions:
+        digest = blake2b('\n'.join(missing).encode('utf-8')).hexdigest()
+        key = f'{arg.query}\t{len(missing)}\t{digest}'
+    else:
+        missing = [None] * count
+        fetch_handle = query_handle
+        key = f'{arg.query}\t{count}'
+    parts = []
+    failed = 0
+    if missing:
+        log.info('\tDownloading...')
+        log.warning('\tMay be slow if connection is bad. Ctrl+C to quit.')
+        parts, failed = download_batches(fetch_handle, len(missing), key, arg,
+                                         limiter, RETRY_MAX)
+        if parts is None:
+            log.info('Abort download.')
+            return None
+    if cache is None:
+        with open(file_name, 'wb') as output:
+            for part in parts:
+                with open(part, 'rb') as _:
+                    copyfileobj(_, output)
+    else:
+        new = []
+        for part in parts:
+            new.extend(cache.add(part))
+        cache.save()
+        # records may be updated during download
+        extra = set(new) - set(accessions)
+        keys = [i for i in accessions if i in cache]
+        keys.extend(i for i in new if i in extra)
+        with open(file_name, 'wb') as output:
+            cache.write(keys, output)
+    # without cache, keep finished batches for resuming
+    if parts and (failed == 0 or cache is not None):
+        rmtree(parts[0].parent, ignore_errors=True)
+    if failed != 0:
+        log.warning('Download finished with some batches skipped.')
+    else:
+        log.info('Download finished.')
     return file_name
 
 
-def clean_gb(gbfile):
+def scan_gb(gbfile: Path, start=0, end=None):
     """
-    Records in Genbank may be problematic. Check it before parse and skip
-    abnormal records.
+    Find boundaries of records by searching "//" line in memory-mapped file,
+    without parsing. Blank lines between records were skipped, thus each
+    record starts with "LOCUS".
+    Incomplete record at the end of the file was ignored.
+    Args:
+        gbfile: genbank file
+        start: offset to start, should be the beginning of a record
+        end: offset to stop, should be the end of a record, None for end of
+        the file
+    Yields:
+        start: offset of the record
+        data: bytes of the record
     """
-    log.info('\tCheck Genbank file to remove abnormal records.')
+    with open(gbfile, 'rb') as raw:
+        try:
+            mm = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+    with mm:
+        size = len(mm) if end is None else min(end, len(mm))
+        while start < size:
+            # skip blank lines between records
+            while start < size and mm[start:start+1].isspace():
+                start += 1
+            if start == size:
+                break
+            if mm[start:start+2] == b'//':
+                end = start
+            else:
+                end = mm.find(b'\n//', start, size)
+                if end == -1:
+                    if mm[start:].strip():
+                        log.debug(f'Incomplete record at the end of {gbfile}.')
+                    break
+                end += 1
+            line_end = mm.find(b'\n', end, size)
+            end = size if line_end == -1 else line_end + 1
+            yield start, mm[start:end]
+            start = end
+
+
+def split_location(text: str) -> list:
+    """
+    Split location string by commas that are not in brackets.
+    """
+    parts = []
+    depth = 0
+    last = 0
+    for index, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[last:index])
+            last = index + 1
+    parts.append(text[last:])
+    return parts
+
+
+def parse_location(text: str):
+    """
+    Parse location string of genbank feature.
+    Only handle exact and "<" ">" positions, with complement, join and order.
+    Args:
+        text: location string without whitespace
+    Returns:
+        location: FeatureLocation or CompoundLocation
+    Raises:
+        ValueError: for remote, between or other rare locations
+    """
+    match = SIMPLE_LOCATION.match(text)
+    if match is not None:
+        before, start, after, end = match.groups()
+        if end is None:
+            if before:
+                raise ValueError(f'Unsupported location {text}')
+            end = start
+        start = int(start) - 1
+        end = int(end)
+        if start > end:
+            raise ValueError(f'Bad location {text}')
+        if before:
+            start = BeforePosition(start)
+        if after:
+            end = AfterPosition(end)
+        return FeatureLocation(start, end, 1)
+    if text.startswith('complement(') and text.endswith(')'):
+        location = parse_location(text[11:-1])
+        if isinstance(location, CompoundLocation):
+            parts = [FeatureLocation(i.start, i.end, -1)
+                     for i in reversed(location.parts)]
+            return CompoundLocation(parts, location.operator)
+        return FeatureLocation(location.start, location.end, -1)
+    for operator in ('join', 'order'):
+        if text.startswith(operator+'(') and text.endswith(')'):
+            parts = [parse_location(i) for i in split_location(
+                text[len(operator)+1:-1])]
+            if any(isinstance(i, CompoundLocation) for i in parts):
+                raise ValueError(f'Nested location {text}')
+            if len(parts) == 1:
+                return parts[0]
+            return CompoundLocation(parts, operator)
+    raise ValueError(f'Unsupported location {text}')
+
 
-    def parse_gb(handle):
-        record = []
-        for line in handle:
-            record.append(line)
-            if line.startswith('//'):
-                yield record
-                record = []
+def parse_qualifiers(text: str) -> dict:
+    """
+    Parse qualifiers of one feature.
+    Only keep qualifiers in QUALIFIERS.
+    Args:
+        text: qualifier lines of the feature
+    Returns:
+        qualifiers: {key: [value, ]}
+    """
+    qualifiers = defaultdict(list)
+    for match in QUALIFIER.finditer(text):
+        key, value = match.groups()
+        if key not in QUALIFIERS:
+            continue
+        if value is None:
+            qualifiers[key].append('')
+            continue
+        # multiple lines
+        if '\n' in value:
+            value = ' '.join(i.strip() for i in value.splitlines())
+        if value.startswith('"'):
+            value = value[1:-1].replace('""', '"')
+        qualifiers[key].append(value)
+    return dict(qualifiers)
+
+
+def parse_gb_record(data: bytes) -> SeqRecord:
+    """
+    Parse one genbank record with only information used by divide(),
+    i.e., id, accessions, organism, taxonomy, sequence and features in
+    FEATURE_TYPES. Other features and qualifiers were skipped without
+    parsing.
+    Args:
+        data: bytes of one record
+    Returns:
+        record: SeqRecord
+    Raises:
+        ValueError: if the record is abnormal or have unsupported locations
+    """
+    # records from old index may start with blank lines
+    text = data.decode('utf-8', errors='replace').lstrip()
+    origin = text.find('\nORIGIN')
+    if not text.startswith('LOCUS') or origin == -1:
+        raise ValueError('Missing LOCUS or ORIGIN')
+    head_end = text.find('\nFEATURES')
+    if head_end == -1:
+        head_end = origin
+    # header
+    fields = defaultdict(list)
+    key = None
+    for line in text[:head_end].splitlines():
+        # keyword or sub-keyword like "  ORGANISM"
+        if line[:12].strip():
+            key = line[:12].strip()
+        fields[key].append(line[12:].strip())
+    locus = fields['LOCUS'][0].split()
+    if len(locus) < 2 or not locus[1].isdigit():
+        raise ValueError('Bad LOCUS line')
+    length = int(locus[1])
+    accessions = ' '.join(fields['ACCESSION']).split()
+    version = ' '.join(fields['VERSION']).split()
+    record_id = version[0] if version else (
+        accessions[0] if accessions else locus[0])
+    organism, *lineage = fields['ORGANISM'] or ['']
+    # organism name may take more than one line
+    while lineage and ';' not in lineage[0] and not lineage[0].endswith('.'):
+        organism += ' ' + lineage.pop(0)
+    lineage = ' '.join(lineage).rstrip('.')
+    taxonomy = [i.strip() for i in lineage.split(';') if i.strip()]
+    # sequence
+    body_end = text.rfind('\n//')
+    seq_start = text.find('\n', origin+1)
+    sequence = text[seq_start:body_end].translate(SEQUENCE_DELETE).upper()
+    if len(sequence) != length:
+        raise ValueError(f'Expect {length} bp but got {len(sequence)} bp')
+    # features
+    features = []
+    feature_text = text[head_end:origin+1]
+    # other sections like "BASE COUNT"
+    section_end = re.search(r'\n\S', feature_text[1:])
+    if section_end is not None:
+        feature_text = feature_text[:section_end.start()+1]
+    starts = list(FEATURE_START.finditer(feature_text))
+    for index, match in enumerate(starts):
+        feature_type = match.group(1)
+        if feature_type not in FEATURE_TYPES:
+            continue
+        if index + 1 < len(starts):
+            block = feature_text[match.end():starts[index+1].start()]
+        else:
+            block = feature_text[match.end():]
+        qualifier_start = block.find(QUALIFIER_START)
+        if qualifier_start == -1:
+            qualifier_start = len(block)
+        location = match.group(2) + block[:qualifier_start]
+        location = parse_location(''.join(location.split()))
+        feature = SeqFeature(location, type=feature_type,
+                             qualifiers=parse_qualifiers(
+                                 block[qualifier_start:]))
+        if isinstance(location, CompoundLocation):
+            feature.location_operator = location.operator
+        else:
+            feature.location_operator = ''
+        features.append(feature)
+    record = SeqRecord(Seq(sequence), id=record_id, name=locus[0],
+                       description=' '.join(fields['DEFINITION']),
+                       features=features)
+    record.annotations['accessions'] = accessions
+    record.annotations['organism'] = organism
+    record.annotations['taxonomy'] = taxonomy
+    return record
+
+
+def get_batches(gbfile: Path, batch_size: int) -> list:
+    """
+    Split genbank file into batches of whole records, each batch is about
+    batch_size bytes. Only search "//" line near the boundaries.
+    Args:
+        gbfile: genbank file
+        batch_size: size of each batch
+    Returns:
+        batches: [(start, end), ]
+    """
+    batches = []
+    with open(gbfile, 'rb') as raw:
+        try:
+            mm = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return batches
+    with mm:
+        size = len(mm)
+        start = 0
+        while start < size:
+            end = mm.find(b'\n//', min(size, start+batch_size)-1)
+            if end == -1:
+                end = size
             else:
-                pass
+                line_end = mm.find(b'\n', end+1)
+                end = size if line_end == -1 else line_end + 1
+            batches.append((start, end))
+            start = end
+    return batches
+
 
+def clean_gb(gbfile, start=0, end=None, offsets=None, index=None):
+    """
+    Records in Genbank may be problematic. Check it before parse and skip
+    abnormal records.
+    Records were splitted by scan_gb() and parsed by parse_gb_record(),
+    unsupported records were parsed by Biopython instead.
+    Args:
+        gbfile: genbank file
+        start: offset to start
+        end: offset to stop, None for end of the file
+        offsets: [(offset, length), ] of records to read instead of
+        scanning from start to end
+        index: list to collect index entries of records, or None
+    Yields:
+        gb_record: SeqRecord
+    """
+    log.debug(f'\tCheck records from {start} of {gbfile}.')
     wrong = 0
-    old_gb = open(gbfile, 'r')
-    tmp_gb = StringIO()
-    for record in parse_gb(old_gb):
-        # StringIO is faster than write tmp file to disk and read
-        tmp_gb = StringIO()
-        for _ in record:
-            tmp_gb.write(_)
-        tmp_gb.seek(0)
+    if offsets is None:
+        chunks = scan_gb(gbfile, start, end)
+    else:
+        chunks = read_gb(gbfile, offsets)
+    for start, data in chunks:
         try:
-            gb_record = SeqIO.read(tmp_gb, 'gb')
-            yield gb_record
-        except Exception as e:
-            log.critical('\tFound problematic record {}: {}'.format(
-                record[0][:25], e.args[0]))
-            wrong += 1
-    tmp_gb.close()
-    old_gb.close()
+            gb_record = parse_gb_record(data)
+        except ValueError as e:
+            log.debug(f'\tUse Biopython to parse record at {start}: {e}')
+            gb_record = None
+        if gb_record is None:
+            # only parse this record again
+            tmp_gb = StringIO(data.decode('utf-8', errors='replace'))
+            try:
+                gb_record = SeqIO.read(tmp_gb, 'gb')
+            except Exception as e:
+                log.critical('\tFound problematic record {}: {}'.format(
+                    data[:25].decode('utf-8', errors='replace'), e.args[0]))
+                wrong += 1
+                continue
+        if index is not None:
+            index.append(get_index_entry(gb_record, start, len(data)))
+        yield gb_record
     if wrong != 0:
         log.info('\tRemove {} abnormal records.'.format(wrong))
 
 
+def read_gb(gbfile: Path, offsets: list):
+    """
+    Read records in given positions, without scanning the whole file.
+    Args:
+        gbfile: genbank file
+        offsets: [(offset, length), ]
+    Yields:
+        offset: offset of the record
+        data: bytes of the record
+    """
+    with open(gbfile, 'rb') as raw:
+        for offset, length in offsets:
+            raw.seek(offset)
+            yield offset, raw.read(length)
+
+
+def get_index_entry(record, offset: int, length: int) -> dict:
+    """
+    Summary of one record for the index of genbank file.
+    Args:
+        record: SeqRecord
+        offset: offset of the record in the file
+        length: bytes of the record
+    Returns:
+        entry: dict
+    """
+    types = defaultdict(int)
+    genes = set()
+    for feature in record.features:
+        types[feature.type] += 1
+        for key in ('gene', 'product'):
+            genes.update(feature.qualifiers.get(key, []))
+    accession = record.annotations.get('accessions', [record.id, ])[0]
+    return {'accession': accession, 'offset': offset, 'length': length,
+            'organism': record.annotations.get('organism', ''),
+            'taxonomy': record.annotations.get('taxonomy', []),
+            'features': dict(types), 'genes': sorted(genes)}
+
+
+def get_index_file(gbfile: Path) -> Path:
+    return gbfile.with_name(gbfile.name+INDEX_SUFFIX)
+
+
+def load_index(gbfile: Path):
+    """
+    Load index of genbank file built by former divide().
+    The index was ignored if the genbank file was changed after that.
+    Args:
+        gbfile: genbank file
+    Returns:
+        entries: list of index entries, None if not available
+    """
+    index_file = get_index_file(gbfile)
+    if not index_file.exists():
+        return None
+    try:
+        with open(index_file, 'r', encoding='utf-8') as _:
+            index = json.load(_)
+    except Exception:
+        log.debug(f'Bad index {index_file}, ignore it.')
+        return None
+    stat = gbfile.stat()
+    if (index.get('size') != stat.st_size or
+            index.get('mtime') != stat.st_mtime_ns):
+        log.debug(f'{gbfile} was changed, ignore old index.')
+        return None
+    return index['records']
+
+
+def save_index(gbfile: Path, entries: list):
+    """
+    Save index of genbank file next to it.
+    Args:
+        gbfile: genbank file
+        entries: list of index entries
+    """
+    index_file = get_index_file(gbfile)
+    stat = gbfile.stat()
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+             'records': entries}
+    tmp_file = index_file.with_suffix('.tmp')
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as _:
+            json.dump(index, _)
+        tmp_file.replace(index_file)
+    except OSError:
+        log.warning(f'Cannot write index of {gbfile}.')
+        return
+    log.info(f'\tIndex of {gbfile} was saved into {index_file}.')
+
+
+def match_entry(entry: dict, arg) -> bool:
+    """
+    Check if the record matches "-filter_taxon" and "-filter_gene".
+    Taxon could be any rank in the lineage, genus or species name; gene
+    could be gene or product name. Case insensitive.
+    Args:
+        entry: index entry
+        arg: arguments
+    Returns:
+        match: bool
+    """
+    if arg.filter_taxon:
+        organism = entry['organism'].lower()
+        names = {i.lower() for i in entry['taxonomy']}
+        names.update((organism, organism.split(' ')[0]))
+        if not names.intersection(i.replace('_', ' ').lower()
+                                  for i in arg.filter_taxon):
+            return False
+    if arg.filter_gene:
+        genes = {i.lower() for i in entry['genes']}
+        if not genes.intersection(i.lower() for i in arg.filter_gene):
+            return False
+    return True
+
+
+def get_offset_batches(offsets: list, batch_size: int) -> list:
+    """
+    Split positions of records into batches of about batch_size bytes.
+    Args:
+        offsets: [(offset, length), ]
+        batch_size: size of each batch
+    Returns:
+        batches: [[(offset, length), ], ]
+    """
+    batches = []
+    batch = []
+    size = 0
+    for offset, length in offsets:
+        batch.append((offset, length))
+        size += length
+        if size >= batch_size:
+            batches.append(batch)
+            batch = []
+            size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def get_feature_name(feature, arg):
     """
     Get feature name and collect genes for extract spacer.
@@ -389,9 +1232,66 @@ def get_feature_name(feature, arg):
     return name
 
 
+class IntervalIndex:
+    """
+    Intervals of one record sorted by start, with the interval having the
+    maximum end among former ones (cover), built once and then used for
+    checking gaps and overlap without comparing all pairs.
+    """
+    __slots__ = ('starts', 'ends', 'items', 'cover')
+
+    def __init__(self, intervals: list):
+        """
+        Args:
+            intervals: [(start, end, item), ]
+        """
+        # stable, same order as sort by start
+        intervals = sorted(intervals, key=lambda x: int(x[0]))
+        self.starts = [int(i[0]) for i in intervals]
+        self.ends = [int(i[1]) for i in intervals]
+        self.items = [i[2] for i in intervals]
+        self.cover = []
+        last = 0
+        for index, end in enumerate(self.ends):
+            # the later one if have same end
+            if end >= self.ends[last]:
+                last = index
+            self.cover.append(last)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get_cover(self, index: int) -> int:
+        """
+        Get the interval with the maximum end among intervals before the
+        given one, i.e., the nearest upstream feature which a gap could
+        start from.
+        Args:
+            index: index of the interval
+        Returns:
+            cover: index of the interval, -1 for the first interval
+        """
+        if index == 0:
+            return -1
+        return self.cover[index-1]
+
+    def first_overlap(self) -> int:
+        """
+        Get the first interval that overlaps with former intervals.
+        Returns:
+            index: index of the interval, len(self) if no overlap
+        """
+        for index in range(1, len(self.items)):
+            if self.ends[self.cover[index-1]] >= self.starts[index]:
+                return index
+        return len(self.items)
+
+
 def get_spacer(genes):
     """
     Given list of genes, extract spacers.
+    If the upstream gene is nested in another gene, the spacer starts from
+    the end of the outer gene.
     genes: [name, feature]
     """
     if len(genes) <= 1:
@@ -399,10 +1299,14 @@ def get_spacer(genes):
     spacers = list()
     names = set()
     # sorted according to sequence starting position
-    genes.sort(key=lambda x: int(x[1].location.start))
-    for i in range(len(genes)-1):
-        b_name, before = genes[i]
-        c_name, current = genes[i+1]
+    index = IntervalIndex([(i[1].location.start, i[1].location.end, i)
+                           for i in genes])
+    for i in range(1, len(index)):
+        b_name, before = index.items[i-1]
+        c_name, current = index.items[i]
+        cover = index.get_cover(i)
+        if index.ends[cover] <= index.starts[i]:
+            b_name, before = index.items[cover]
         invert_repeat = False
         repeat = False
         # gene name may contain "_", use "-" instead
@@ -476,14 +1380,14 @@ def get_intron(genes):
         # exons.append(exon)
         strand = feature.location.strand
         # sort by start, no matter which strand
-        parts = sorted(feature.location.parts, key=lambda x: x.start)
+        index = IntervalIndex([(i.start, i.end, i)
+                               for i in feature.location.parts])
+        parts = index.items
         n_part = len(parts)
-        for i in range(len(parts)-1):
+        # Z00028, skip introns after overlapped exons
+        for i in range(index.first_overlap()-1):
             before = parts[i]
             current = parts[i+1]
-            # Z00028
-            if before.end >= current.start:
-                break
             # complement strand use reversed index
             # n_intron start with 1 instead of 0
             if strand != -1:
@@ -502,160 +1406,400 @@ def get_intron(genes):
     return introns
 
 
+def build_taxon_table() -> dict:
+    """
+    Compile taxonomy lists in data folder into one dict.
+    Name in several lists use the rank with highest priority, i.e.,
+    superkingdom > kingdom > phylum > class, the same as get_taxon().
+    Returns:
+        table: {name: (rank, rank)}, the second rank is for order and family
+    """
+    first = {}
+    # lower priority first, then overwritten by higher
+    for filename, rank in zip(reversed(TAXON_DATA),
+                              (ORDER, CLASS, PHYLUM, KINGDOM, KINGDOM)):
+        with open(resource_filename('BarcodeFinder', f'data/{filename}'),
+                  'r') as _:
+            names = _.read().split(',')
+        if rank == ORDER:
+            animal_orders = names
+        else:
+            first.update(dict.fromkeys(names, rank))
+    table = {name: (rank, get_suffix_rank(name)) for name, rank in
+             first.items()}
+    for name in animal_orders:
+        table[name] = (first.get(name), ORDER)
+    return table
+
+
+def get_suffix_rank(name: str):
+    """
+    Get rank of order or family by suffix.
+    Args:
+        name: taxon name
+    Returns:
+        rank: ORDER, FAMILY or None
+    """
+    if name.endswith('ales'):
+        return ORDER
+    elif name.endswith('aceae') or name.endswith('idae'):
+        return FAMILY
+    return None
+
+
+def get_taxon_table() -> dict:
+    """
+    Load compiled taxonomy table lazily. The table was cached as pickle file
+    in third_party folder and rebuilt if data files were changed.
+    Returns:
+        table: {name: (rank, rank)}
+    """
+    global _TAXON_TABLE
+    if _TAXON_TABLE is not None:
+        return _TAXON_TABLE
+    stamp = []
+    for filename in TAXON_DATA:
+        stat = Path(resource_filename('BarcodeFinder',
+                                      f'data/{filename}')).stat()
+        stamp.append((filename, stat.st_size, stat.st_mtime_ns))
+    success, third_party = utils.get_third_party()
+    cache_file = third_party / TAXON_TABLE_FILE
+    if success and cache_file.exists():
+        try:
+            with open(cache_file, 'rb') as _:
+                cache = pickle.load(_)
+            if cache['stamp'] == stamp:
+                _TAXON_TABLE = cache['table']
+                return _TAXON_TABLE
+        except Exception:
+            log.debug(f'Bad taxonomy cache {cache_file}, rebuild it.')
+    _TAXON_TABLE = build_taxon_table()
+    if success:
+        tmp_file = cache_file.with_suffix('.tmp')
+        try:
+            with open(tmp_file, 'wb') as _:
+                pickle.dump({'stamp': stamp, 'table': _TAXON_TABLE}, _,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_file.replace(cache_file)
+        except OSError:
+            log.debug(f'Cannot write taxonomy cache {cache_file}.')
+    return _TAXON_TABLE
+
+
+@lru_cache(maxsize=65536)
+def resolve_taxon(taxonomy: tuple) -> tuple:
+    """
+    Resolve taxonomy lineage, memoized, thus records of the same lineage
+    only need one dict lookup.
+    Args:
+        taxonomy: tuple of lineage names
+    Returns:
+        (kingdom, phylum, class, order, family)
+    """
+    table = get_taxon_table()
+    result = ['', '', '', '', '']
+    for item in taxonomy:
+        ranks = table.get(item)
+        if ranks is None:
+            rank = get_suffix_rank(item)
+            if rank is not None:
+                result[rank] = item
+            continue
+        for rank in ranks:
+            if rank is not None:
+                result[rank] = item
+    # get fake class for plant
+    if result[PHYLUM] == 'Streptophyta' and result[CLASS] == '':
+        last_phyta = ''
+        for i in taxonomy:
+            if i.endswith('phyta'):
+                last_phyta = i
+        try:
+            result[CLASS] = taxonomy[taxonomy.index(last_phyta) + 1]
+        except IndexError:
+            result[CLASS] = ''
+    return tuple(result)
+
+
+def get_taxon(taxon_str):
+    """
+    Get taxon info based on suffix and list from NCBI taxonomy database.
+    """
+    # kingdom|phylum|class|order|family|organims(genus|species)
+    return resolve_taxon(tuple(taxon_str))
+
+
+def divide_record(record, handle_raw, arg, writer):
+    """
+    Divide one genbank record by annotation.
+    Args:
+        record: SeqRecord
+        handle_raw: handle of raw fasta
+        arg: arguments
+        writer: utils.WriterPool for output files
+    """
+    # only accept gene, product, and spacer in misc_features.note
+    taxon_str = record.annotations.get('taxonomy', None)
+    if taxon_str is None:
+        kingdom, phylum, class_, order, family = '', '', '', '', ''
+    else:
+        kingdom, phylum, class_, order, family = get_taxon(taxon_str)
+    # gb annotation may be empty
+    organism = record.annotations.get('organism', None)
+    if organism is not None:
+        organism = organism.replace(' ', '_')
+        genus, *species = organism.split('_')
+    else:
+        genus, species = '', ''
+    # species name may contain other characters
+    taxon = '{}|{}|{}|{}|{}|{}|{}'.format(kingdom, phylum, class_,
+                                          order, family, genus,
+                                          '_'.join(species))
+    accession = record.annotations.get('accessions', ['', ])[0]
+    specimen = record.features[0].qualifiers.get('specimen_voucher',
+                                                 ['', ])
+    specimen = specimen[0].replace(' ', '_')
+    isolate = record.features[0].qualifiers.get('isolate', ['', ])
+    isolate = isolate[0].replace(' ', '_')
+    # usually the record only has one of them
+    specimen = '_'.join([specimen, isolate]).rstrip('_')
+    seq_info = (taxon, accession, specimen)
+    whole_seq = record.seq
+    feature_name = []
+    have_intron = {}
+    genes = []
+    not_genes = []
+    # get genes
+    for feature in record.features:
+        # skip unsupport feature
+        # support: gene, CDS, tRNA, rRNA, misc_feature, misc_RNA
+        name = get_feature_name(feature, arg)
+        if name is None:
+            continue
+        if len(name) > arg.max_name_len:
+            log.debug(f'Too long name: {name}. Truncated.')
+            name = name[:arg.max_name_len-3] + '...'
+        if feature.type == 'gene':
+            genes.append([name, feature])
+            # only use gene name as sequence id
+            feature_name.append(name)
+        else:
+            not_genes.append([name, feature])
+        if feature.location_operator == 'join':
+            # use dict to remove repeat name of gene/CDS/tRNA/rRNA
+            have_intron[name] = feature
+
+    # write genes
+    write_seq(genes, seq_info, whole_seq, arg, writer)
+    # write non-genes
+    write_seq(not_genes, seq_info, whole_seq, arg, writer)
+    # extract spacer
+    spacers = get_spacer(genes)
+    # write spacer annotations
+    if not arg.allow_mosaic_spacer:
+        spacers = [i for i in spacers if i.type != 'mosaic_spacer']
+    # record.features.extend(spacers)
+    # extract intron
+    introns = get_intron(have_intron.items())
+    # record.features.extend(introns)
+    if not arg.allow_invert_repeat:
+        spacers = [i for i in spacers if i.qualifiers[
+            'invert_repeat'] == 'False']
+    # write seq
+    spacers_to_write = [[i.id, i] for i in spacers]
+    # write intron or not?
+    introns_to_write = [(i.id, i) for i in introns]
+    write_seq(spacers_to_write, seq_info, whole_seq, arg, writer)
+    write_seq(introns_to_write, seq_info, whole_seq, arg, writer)
+    # write to group_by name, i.e., one gb record one fasta
+    if 'ITS' in feature_name:
+        name_str = 'ITS'
+    elif len(feature_name) >= 4:
+        name_str = '{}-...-{}'.format(feature_name[0], feature_name[-1])
+    elif len(feature_name) == 0:
+        name_str = 'Unknown'
+    else:
+        name_str = '-'.join(feature_name)
+    # directly use genome type as name
+    if arg.organelle not in ('ignore', 'no', 'both'):
+        name_str = '{}_genome'.format(arg.organelle)
+    record.id = '|'.join([name_str, taxon, accession, specimen])
+    record.description = ''
+    filename = arg._fasta / (name_str+'.fasta')
+    SeqIO.write(record, writer.get(filename), 'fasta')
+    # write raw fasta
+    SeqIO.write(record, handle_raw, 'fasta')
+
+
+def divide_records(gbfile: Path, batch: tuple, handle_raw, arg,
+                   writer) -> list:
+    """
+    Divide records of one batch.
+    Args:
+        gbfile: genbank file
+        batch: (start, end, offsets), see clean_gb()
+        handle_raw: handle of raw fasta
+        arg: arguments
+        writer: utils.WriterPool for output files
+    Returns:
+        index: index entries of records, empty if records were given by
+        offsets
+    """
+    start, end, offsets = batch
+    index = [] if offsets is None else None
+    filtered = offsets is None and (arg.filter_taxon or arg.filter_gene)
+    for record in clean_gb(gbfile, start, end, offsets, index):
+        if filtered and not match_entry(index[-1], arg):
+            continue
+        divide_record(record, handle_raw, arg, writer)
+    return index or []
+
+
+def divide_batch(gbfile: Path, batch: tuple, shard: Path, arg) -> tuple:
+    """
+    Divide records of one batch of genbank file into shard folder, which
+    has the same structure as the output folder.
+    Args:
+        gbfile: genbank file
+        batch: (start, end, offsets), see clean_gb()
+        shard: folder for output of the batch
+        arg: arguments
+    Returns:
+        shard: folder for output of the batch
+        index: index entries of records
+    """
+    arg = copy(arg)
+    arg._fasta = shard / arg._fasta.name
+    arg._divide = shard / arg._divide.name
+    arg._expand = shard / arg._expand.name
+    for folder in (arg._fasta, arg._divide, arg._expand):
+        folder.mkdir(parents=True, exist_ok=True)
+    with open(shard/(gbfile.stem+'.fasta'), 'w', encoding='utf-8') as raw, \
+            utils.WriterPool() as writer:
+        index = divide_records(gbfile, batch, raw, arg, writer)
+    return shard, index
+
+
+def merge_shard(shard: Path, raw_fasta: Path, arg):
+    """
+    Append files in shard folder to the output folder and remove the shard.
+    Args:
+        shard: folder from divide_batch()
+        raw_fasta: raw fasta of the genbank file
+        arg: arguments
+    """
+    targets = [(shard/(raw_fasta.stem+'.fasta'), raw_fasta)]
+    for folder in (arg._fasta, arg._divide, arg._expand):
+        with scandir(shard/folder.name) as files:
+            names = sorted(i.name for i in files)
+        targets.extend((shard/folder.name/i, folder/i) for i in names)
+    for source, target in targets:
+        with open(source, 'rb') as in_, open(target, 'ab') as out:
+            copyfileobj(in_, out)
+    rmtree(shard)
+
+
 def divide(gbfile, arg):
     """
     Given genbank file, return divided fasta files.
+    Large file was splitted into batches of records and divided by
+    "threads" processes. Output of each batch were written into a shard
+    folder, then shards were merged in order of batches, thus records in
+    the output have the same order as the genbank file.
+    An index of records was saved next to the genbank file. If
+    "-filter_taxon" or "-filter_gene" was set, next run only reads matched
+    records according to the index, instead of scanning the whole file.
     """
     log.info('Divide {} by annotation.'.format(gbfile))
-
-    def get_taxon(taxon_str):
-        """
-        Get taxon info based on suffix and list from NCBI taxonomy database.
-        """
-        # kingdom|phylum|class|order|family|organims(genus|species)
-        # add my_ prefix to avoid conflict of "class"
-        my_kingdom = ''
-        my_phylum = ''
-        my_class = ''
-        my_order = ''
-        my_family = ''
-        for item in taxon_str:
-            if item in SUPERKINGDOMS:
-                my_kingdom = item
-            # mix superkingdom and kingdom to reduce name length
-            elif item in KINGDOMS:
-                my_kingdom = item
-            elif item in PHYLA:
-                my_phylum = item
-            elif item in CLASSES:
-                my_class = item
-            if item.endswith('ales') or item in ANIMAL_ORDERS:
-                my_order = item
-            elif item.endswith('aceae') or item.endswith('idae'):
-                my_family = item
-        # get fake class for plant
-        if my_phylum == 'Streptophyta' and my_class == '':
-            last_phyta = ''
-            for i in taxon_str:
-                if i.endswith('phyta'):
-                    last_phyta = i
-            try:
-                my_class = taxon_str[taxon_str.index(last_phyta) + 1]
-            except IndexError:
-                my_class = ''
-        return my_kingdom, my_phylum, my_class, my_order, my_family
-
+    log.info('\tCheck Genbank file to remove abnormal records.')
     raw_fasta = arg._fasta / (gbfile.stem+'.fasta')
-    handle_raw = open(raw_fasta, 'w', encoding='utf-8')
-    for record in clean_gb(gbfile):
-        # only accept gene, product, and spacer in misc_features.note
-        taxon_str = record.annotations.get('taxonomy', None)
-        if taxon_str is None:
-            kingdom, phylum, class_, order, family = '', '', '', '', ''
-        else:
-            kingdom, phylum, class_, order, family = get_taxon(taxon_str)
-        # gb annotation may be empty
-        organism = record.annotations.get('organism', None)
-        if organism is not None:
-            organism = organism.replace(' ', '_')
-            genus, *species = organism.split('_')
-        else:
-            genus, species = '', ''
-        # species name may contain other characters
-        taxon = '{}|{}|{}|{}|{}|{}|{}'.format(kingdom, phylum, class_,
-                                              order, family, genus,
-                                              '_'.join(species))
-        accession = record.annotations.get('accessions', ['', ])[0]
-        specimen = record.features[0].qualifiers.get('specimen_voucher',
-                                                     ['', ])
-        specimen = specimen[0].replace(' ', '_')
-        isolate = record.features[0].qualifiers.get('isolate', ['', ])
-        isolate = isolate[0].replace(' ', '_')
-        # usually the record only has one of them
-        specimen = '_'.join([specimen, isolate]).rstrip('_')
-        seq_info = (taxon, accession, specimen)
-        whole_seq = record.seq
-        feature_name = []
-        have_intron = {}
-        genes = []
-        not_genes = []
-        # get genes
-        for feature in record.features:
-            # skip unsupport feature
-            # support: gene, CDS, tRNA, rRNA, misc_feature, misc_RNA
-            name = get_feature_name(feature, arg)
-            if name is None:
-                continue
-            if len(name) > arg.max_name_len:
-                log.debug(f'Too long name: {name}. Truncated.')
-                name = name[:arg.max_name_len-3] + '...'
-            if feature.type == 'gene':
-                genes.append([name, feature])
-                # only use gene name as sequence id
-                feature_name.append(name)
-            else:
-                not_genes.append([name, feature])
-            if feature.location_operator == 'join':
-                # use dict to remove repeat name of gene/CDS/tRNA/rRNA
-                have_intron[name] = feature
-
-        # write genes
-        write_seq(genes, seq_info, whole_seq, arg)
-        # write non-genes
-        write_seq(not_genes, seq_info, whole_seq, arg)
-        # extract spacer
-        spacers = get_spacer(genes)
-        # write spacer annotations
-        if not arg.allow_mosaic_spacer:
-            spacers = [i for i in spacers if i.type != 'mosaic_spacer']
-        # record.features.extend(spacers)
-        # extract intron
-        introns = get_intron(have_intron.items())
-        # record.features.extend(introns)
-        if not arg.allow_invert_repeat:
-            spacers = [i for i in spacers if i.qualifiers[
-                'invert_repeat'] == 'False']
-        # write seq
-        spacers_to_write = [[i.id, i] for i in spacers]
-        # write intron or not?
-        introns_to_write = [(i.id, i) for i in introns]
-        write_seq(spacers_to_write, seq_info, whole_seq, arg)
-        write_seq(introns_to_write, seq_info, whole_seq, arg)
-        # write to group_by name, i.e., one gb record one fasta
-        if 'ITS' in feature_name:
-            name_str = 'ITS'
-        elif len(feature_name) >= 4:
-            name_str = '{}-...-{}'.format(feature_name[0], feature_name[-1])
-        elif len(feature_name) == 0:
-            name_str = 'Unknown'
-        else:
-            name_str = '-'.join(feature_name)
-        # directly use genome type as name
-        if arg.organelle not in ('ignore', 'no', 'both'):
-            name_str = '{}_genome'.format(arg.organelle)
-        record.id = '|'.join([name_str, taxon, accession, specimen])
-        record.description = ''
-        filename = arg._fasta / (name_str+'.fasta')
-        with open(filename, 'a', encoding='utf-8') as out:
-            SeqIO.write(record, out, 'fasta')
-        # write raw fasta
-        SeqIO.write(record, handle_raw, 'fasta')
+    threads = max(1, arg.threads)
+    entries = None
+    if arg.filter_taxon or arg.filter_gene:
+        entries = load_index(gbfile)
+    if entries is not None:
+        offsets = [(i['offset'], i['length']) for i in entries
+                   if match_entry(i, arg)]
+        log.info(f'\tFound index of {gbfile}, {len(offsets)} of '
+                 f'{len(entries)} records match the filter.')
+        batch_size = BATCH_SIZE if threads > 1 else sum(
+            i[1] for i in offsets)
+        batches = [(0, None, i) for i in get_offset_batches(offsets,
+                                                            batch_size)]
+    elif threads > 1 and gbfile.stat().st_size > BATCH_SIZE:
+        batches = [(start, end, None) for start, end in get_batches(
+            gbfile, BATCH_SIZE)]
+    else:
+        batches = [(0, None, None)]
+    index = []
+    if len(batches) <= 1:
+        with open(raw_fasta, 'w', encoding='utf-8') as handle_raw, \
+                utils.WriterPool() as writer:
+            for batch in batches:
+                index.extend(divide_records(gbfile, batch, handle_raw, arg,
+                                            writer))
+    else:
+        log.info(f'Divide {len(batches)} batches with {threads} processes.')
+        shard_root = arg._tmp / ('divide-'+gbfile.stem)
+        # clean old file
+        open(raw_fasta, 'w', encoding='utf-8').close()
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            jobs = [pool.submit(divide_batch, gbfile, batch,
+                                shard_root/f'{n:06d}', arg)
+                    for n, batch in enumerate(batches)]
+            # merge as soon as former batches finished
+            for job in jobs:
+                shard, batch_index = job.result()
+                merge_shard(shard, raw_fasta, arg)
+                index.extend(batch_index)
+        rmtree(shard_root, ignore_errors=True)
+    # only whole file was indexed
+    if entries is None:
+        save_index(gbfile, index)
     # skip analyze of Unknown.fasta
     # unknown = arg._divide / 'Unknown.fasta'
     log.info('Divide finished.')
     return arg._fasta, arg._divide
 
 
-def write_seq(record, seq_info, whole_seq, arg):
+def slice_location(location, sequence: str):
+    """
+    Extract sequence of location by slicing string directly, much faster
+    than feature.extract() which creates Seq for each part.
+    Args:
+        location: FeatureLocation or CompoundLocation
+        sequence: whole sequence of the record
+    Returns:
+        result: str, None for remote location
+    """
+    fragments = []
+    for part in location.parts:
+        # location in other record
+        if part.ref is not None:
+            return None
+        fragment = sequence[int(part.start):int(part.end)]
+        if part.strand == -1:
+            fragment = fragment.translate(COMPLEMENT)[::-1]
+        fragments.append(fragment)
+    return ''.join(fragments)
+
+
+def write_seq(record, seq_info, whole_seq, arg, writer):
     """
     Write fasta files to "by-gene" folder only.
     Args:
         record: [name, feature]
         seq_info: (taxon, accession, specimen)
+        whole_seq: sequence of the record
+        arg: arguments
+        writer: utils.WriterPool for output files
         ID format: >name|taxon|accession|specimen|type
     Return: {filename}
     """
     def careful_extract(name, feature, whole_seq):
+        sequence = slice_location(feature.location, raw_seq)
+        if sequence is not None:
+            return sequence
         # illegal annotation may cause extraction failed
         try:
             sequence = feature.extract(whole_seq)
@@ -666,7 +1810,8 @@ def write_seq(record, seq_info, whole_seq, arg):
         return sequence
 
     path = arg._divide
-    seq_len = len(whole_seq)
+    raw_seq = str(whole_seq)
+    seq_len = len(raw_seq)
     filenames = set()
     expand_files = set()
     record_unique = []
@@ -686,11 +1831,9 @@ def write_seq(record, seq_info, whole_seq, arg):
             log.debug('Annotaion of {} (Accession {}) '
                       'is too long. Skip.'.format(name, seq_info[1]))
         filename = arg._divide / (feature.type+'-'+name+'.fasta')
-        with open(filename, 'a', encoding='utf-8') as handle:
-            sequence_id = '>' + '|'.join([name, *seq_info, feature.type])
-            sequence = careful_extract(name, feature, whole_seq)
-            handle.write(sequence_id+'\n')
-            handle.write(str(sequence)+'\n')
+        sequence_id = '>' + '|'.join([name, *seq_info, feature.type])
+        sequence = careful_extract(name, feature, whole_seq)
+        writer.write(filename, sequence_id+'\n'+str(sequence)+'\n')
         filenames.add(filename)
         if arg.expand != 0:
             if feature.location_operator == 'join':
@@ -709,9 +1852,7 @@ def write_seq(record, seq_info, whole_seq, arg):
                 feature.location = new_loc
             sequence = careful_extract(name, feature, whole_seq)
             filename2 = arg._expand / (feature.type+'-'+name+'.fasta')
-            with open(filename2, 'a', encoding='utf-8') as handle:
-                handle.write(sequence_id + '\n')
-                handle.write(str(sequence) + '\n')
+            writer.write(filename2, sequence_id+'\n'+str(sequence)+'\n')
             expand_files.add(filename2)
     # keep = ('gene.fasta', 'misc_feature', 'misc_RNA', 'spacer')
     # for i in filenames:
@@ -722,56 +1863,98 @@ def write_seq(record, seq_info, whole_seq, arg):
     return filenames
 
 
-def count_for_unique(fasta: Path):
-    info = defaultdict(lambda: list())
-    index = 0
-    count = 0
-    for record in SeqIO.parse(fasta, 'fasta'):
+def scan_fasta(fasta: Path, digest=False):
+    """
+    Find records in fasta file in one pass, without parsing them into
+    SeqRecord.
+    Args:
+        fasta: fasta file
+        digest: calculate digest of sequence or not
+    Yields:
+        start: offset of the record
+        end: offset of the end of the record
+        name: species name, genus and species field of id
+        length: length of sequence
+        digest: bytes, digest of upper case sequence, or None
+    """
+
+    def get_record():
+        header = lines[0][1:].split(None, 1)
+        record_id = header[0].decode('utf-8') if header else ''
         # gene|kingdom|phylum|class|order|family|genus|species|specimen|type
-        count += 1
-        if '|' in record.id:
-            name = ' '.join(record.id.split('|')[6:8])
+        if '|' in record_id:
+            name = ' '.join(record_id.split('|')[6:8])
         else:
-            name = record.id
-        length = len(record)
-        # skip empty file
-        if length != 0:
-            info[name].append([index, length])
-        index += 1
-    return info, count
+            name = record_id
+        seq = b''.join(b''.join(i.split()) for i in lines[1:])
+        seq_digest = None
+        if digest:
+            seq_digest = blake2b(seq.upper(), digest_size=16).digest()
+        return start, offset, name, len(seq), seq_digest
+
+    start = None
+    offset = 0
+    lines = []
+    with open(fasta, 'rb') as raw:
+        for line in raw:
+            if line.startswith(b'>'):
+                if start is not None:
+                    yield get_record()
+                start = offset
+                lines = []
+            if start is not None:
+                lines.append(line)
+            offset += len(line)
+    if start is not None:
+        yield get_record()
 
 
 def unique(files: list, arg) -> list:
     """
     Remove redundant sequences of same species.
+    Records were scanned in one pass, only the best one of each species
+    ("first" or "longest") was remembered, then chosen records were copied
+    by byte ranges. If "-unique_seq" was set, records with identical
+    sequence were also removed even if they belong to different species.
     Files were saved in arg._unique
     """
     log.info('Removing redundant records...')
     unique_files = []
-    # if arg.unique == 'no':
-    #     return unique_files
     total = 0
     kept = 0
     for fasta in files:
-        keep = dict()
-        info, count = count_for_unique(fasta)
-        total += count
-        if arg.unique == 'first':
-            # keep only the first record
-            keep = {info[i][0][0] for i in info}
-        elif arg.unique == 'longest':
-            for i in info:
-                info[i] = sorted(info[i], key=lambda x: x[1], reverse=True)
-            keep = {info[i][0][0] for i in info}
-        else:
-            # ignore "no"
-            pass
-        kept += len(keep)
+        # name: (start, end, length, digest)
+        best = dict()
+        records = []
+        for start, end, name, length, digest in scan_fasta(fasta,
+                                                           arg.unique_seq):
+            total += 1
+            # skip empty sequence
+            if length == 0:
+                continue
+            if arg.unique == 'no':
+                records.append((start, end, length, digest))
+            elif name not in best:
+                best[name] = (start, end, length, digest)
+            elif arg.unique == 'longest' and length > best[name][2]:
+                # keep the first one if have same length
+                best[name] = (start, end, length, digest)
+        if arg.unique != 'no':
+            records = sorted(best.values())
+        if arg.unique_seq:
+            seen = set()
+            unique_records = []
+            for record in records:
+                if record[3] not in seen:
+                    seen.add(record[3])
+                    unique_records.append(record)
+            records = unique_records
+        kept += len(records)
         new = arg._unique / fasta.name
-        with open(new, 'w', encoding='utf-8') as out:
-            for idx, record in enumerate(SeqIO.parse(fasta, 'fasta')):
-                if idx in keep:
-                    SeqIO.write(record, out, 'fasta')
+        with open(fasta, 'rb') as in_, open(new, 'wb') as out:
+            for start, end, *_ in records:
+                in_.seek(start)
+                out.write(in_.read(end-start))
         unique_files.append(new)
     log.info(f'{kept} of {total} records are left.')
     return unique_files
@@ -800,7 +1983,7 @@ def gb2fasta_main():
         return arg, other_args
     for i in arg.gb:
         divide(i, arg)
-    if arg.unique == 'no':
+    if arg.unique == 'no' and not arg.unique_seq:
         log.info('Skip removing redundant sequences.')
         unique_files = arg._divide.glob('*.fasta')
         unique_files = [i for i in unique_files if i.name != 'Unknown.fasta']
@@ -1,14 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import atexit
 import logging
-import re
 import subprocess
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from math import gcd
 from itertools import product as cartesian_product
-from os import cpu_count
+from os import cpu_count, getpid
 from pathlib import Path
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
 import numpy as np
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
@@ -32,6 +41,22 @@ try:
 except ImportError:
     pass
 
+# maximum number of cached primer3 results of concrete sequences
+THERMO_CACHE_SIZE = 1 << 18
+# maximum number of expanded sequences of ambiguous primer
+MAX_EXPAND = 256
+PRIMER_COMPLEMENT = str.maketrans('ACGTMRWSYKVHDBXN', 'TGCAKYWSRMBDHVXN')
+# maximum number of primer candidates in one job of process pool
+PRIMER_CHUNK = 2048
+# consensus in worker process of find_primer()
+_WORKER = {}
+# process pool of find_primer(), shared by all loci
+_POOL = None
+# consensus sent by the initializer of _POOL, only for python < 3.8
+_POOL_DATA = None
+# {pid: (hits, misses, currsize)} of calc_thermo() in worker processes
+_WORKER_CACHE = {}
+
 
 class Pair:
     # save memory
@@ -119,7 +144,7 @@ class Pair:
                 - self.delta_tm * 5 - self.left.avg_mismatch * 10
                 - self.right.avg_mismatch * 10)
 
-    def add_info(self, alignment):
+    def add_info(self, alignment, max_expand=MAX_EXPAND):
         # put attributes that need heavy computation here for the final primer
         # pairs in order to save CPU time
         if not self.right.is_reverse_complement:
@@ -131,15 +156,13 @@ class Pair:
         (self.gap_ratio, self.observed_res, self.entropy, self.pi,
          _, _, self.pd_terminal) = variance[2:9]
         self.heterodimer_tm = calc_ambiguous_seq(
-            calcHeterodimerTm, self.left.seq, self.right.seq)
+            calcHeterodimerTm, self.left.seq, self.right.seq, max_expand)
         if max(self.heterodimer_tm, self.left.tm,
                self.right.tm) == self.heterodimer_tm:
             self.have_heterodimer = True
         else:
             self.have_heterodimer = False
         self.get_score()
-        self.left.update_id()
-        self.right.update_id()
         return self
 
 
@@ -207,6 +230,112 @@ class PrimerWithInfo(SeqRecord):
             self.avg_bitscore, self.start, self.end))
 
 
+class Primer:
+    """
+    Primer passed the validation, much lighter than PrimerWithInfo.
+    PrimerWithInfo (SeqRecord) was only created by to_record() for output.
+    """
+    __slots__ = ('seq', 'quality', 'start', 'end', 'tm', 'hairpin_tm',
+                 'homodimer_tm', 'coverage', 'avg_bitscore', 'avg_mismatch',
+                 'mid_loc', 'avg_mid_loc', 'is_reverse_complement')
+
+    def __init__(self, seq: str, quality, start: int, tm=0.0, hairpin_tm=0.0,
+                 homodimer_tm=0.0, coverage=0.0, avg_bitscore=0.0,
+                 avg_mismatch=0.0, mid_loc=None, is_reverse_complement=False):
+        self.seq = seq
+        self.quality = quality
+        self.start = start
+        self.end = start + len(seq) - 1
+        self.tm = tm
+        self.hairpin_tm = hairpin_tm
+        self.homodimer_tm = homodimer_tm
+        self.coverage = coverage
+        self.avg_bitscore = avg_bitscore
+        self.avg_mismatch = avg_mismatch
+        self.mid_loc = mid_loc
+        self.avg_mid_loc = 0
+        if mid_loc is not None and len(mid_loc) != 0:
+            self.avg_mid_loc = int(utils.safe_average(list(mid_loc.values())))
+        self.is_reverse_complement = is_reverse_complement
+
+    def __len__(self):
+        return len(self.seq)
+
+    def reverse_complement(self):
+        return Primer(self.seq.translate(PRIMER_COMPLEMENT)[::-1],
+                      self.quality[::-1], self.start, self.tm,
+                      self.hairpin_tm, self.homodimer_tm, self.coverage,
+                      self.avg_bitscore, self.avg_mismatch, self.mid_loc,
+                      not self.is_reverse_complement)
+
+    def to_record(self):
+        """
+        Convert to PrimerWithInfo for output.
+        """
+        record = PrimerWithInfo(seq=self.seq, quality=list(self.quality),
+                                start=self.start, coverage=self.coverage,
+                                avg_bitscore=self.avg_bitscore,
+                                mid_loc=self.mid_loc,
+                                avg_mismatch=self.avg_mismatch)
+        record.is_reverse_complement = self.is_reverse_complement
+        record.hairpin_tm = self.hairpin_tm
+        record.homodimer_tm = self.homodimer_tm
+        record.tm = record.annotations['tm'] = self.tm
+        record.update_id()
+        return record
+
+
+class PrimerTable:
+    """
+    Candidate primers of one consensus, stored as parallel arrays instead of
+    one PrimerWithInfo per candidate. Sequence and quality of candidates are
+    slices of the consensus, which is the only sequence buffer.
+    """
+    __slots__ = ('sequence', 'quality', 'start', 'length', 'tm', 'hairpin_tm',
+                 'homodimer_tm', 'coverage', 'avg_bitscore', 'avg_mismatch')
+
+    def __init__(self, sequence: str, quality, start: list, length: list,
+                 tm: list, hairpin_tm: list, homodimer_tm: list):
+        self.sequence = sequence.encode('ascii', errors='replace')
+        self.quality = np.asarray(quality)
+        self.start = np.array(start, dtype=np.int64)
+        self.length = np.array(length, dtype=np.int64)
+        self.tm = np.array(tm, dtype=np.float64)
+        self.hairpin_tm = np.array(hairpin_tm, dtype=np.float64)
+        self.homodimer_tm = np.array(homodimer_tm, dtype=np.float64)
+        self.coverage = np.zeros(len(self.start), dtype=np.float64)
+        self.avg_bitscore = np.zeros(len(self.start), dtype=np.float64)
+        self.avg_mismatch = np.zeros(len(self.start), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.start)
+
+    def get_seq(self, index: int) -> str:
+        start = self.start[index]
+        return self.sequence[start:start+self.length[index]].decode('ascii')
+
+    def get_id(self, index: int) -> str:
+        """
+        Same format as PrimerWithInfo.id.
+        """
+        start = int(self.start[index])
+        end = start + int(self.length[index]) - 1
+        return ('AvgMidLocation({:.0f})-Tm({:.2f})-Coverage({:.2%})-'
+                'AvgBitScore({:.2f})-Start({})-End({})'.format(
+            0, self.tm[index], self.coverage[index],
+            self.avg_bitscore[index], start, end))
+
+    def get_primer(self, index: int, mid_loc=None) -> Primer:
+        start = int(self.start[index])
+        end = start + int(self.length[index])
+        return Primer(self.get_seq(index), self.quality[start:end], start,
+                      float(self.tm[index]), float(self.hairpin_tm[index]),
+                      float(self.homodimer_tm[index]),
+                      float(self.coverage[index]),
+                      float(self.avg_bitscore[index]),
+                      float(self.avg_mismatch[index]), mid_loc)
+
+
 def parse_args(arg_str=None):
     arg = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -217,10 +346,16 @@ def parse_args(arg_str=None):
     arg.add_argument('-aln_folder', default=None,
                      help='folder of aligned files')
     arg.add_argument('-out', help='output directory')
+    arg.add_argument('-threads', type=int, default=max(1, cpu_count()-1),
+                     help='number of threads')
     arg.add_argument('-ambiguous', dest='ambiguous_base_n', default=4, type=int,
                         help='number of ambiguous bases')
     arg.add_argument('-coverage', dest='coverage', default=0.5, type=float,
                         help='minimal coverage of base and primer')
+    arg.add_argument('-max_expand', default=MAX_EXPAND,
+                     type=utils.positive_int,
+                     help='maximum number of expanded sequences of '
+                          'ambiguous primer')
     arg.add_argument('-mismatch', dest='mismatch', default=4, type=int,
                         help='maximum mismatch bases in primer')
     arg.add_argument('-pmin', dest='min_primer', default=20, type=int,
@@ -265,76 +400,159 @@ def init_arg(arg):
     return arg
 
 
-def calc_ambiguous_seq(func, seq, seq2=None):
+@lru_cache(maxsize=THERMO_CACHE_SIZE)
+def calc_thermo(func, seq: str, seq2=None) -> float:
+    """
+    Call primer3 function on concrete sequences, memoized. Overlapping
+    primer candidates and conserved regions of different loci share most
+    of expanded sequences.
+    Args:
+        func: calcTm, calcHairpinTm, calcHomodimerTm or calcHeterodimerTm
+        seq: sequence without ambiguous bases
+        seq2: second sequence for calcHeterodimerTm
+    Returns:
+        value: float
+    """
+    if seq2 is None:
+        return func(seq)
+    return func(seq, seq2)
+
+
+@lru_cache(maxsize=THERMO_CACHE_SIZE)
+def get_choices(seq: str) -> tuple:
+    """
+    Get possible bases of each position.
+    Args:
+        seq: sequence with ambiguous bases
+    Returns:
+        choices: tuple of str
+    """
+    # replace illegal base with 'N'
+    return tuple(ambiguous_data.get(base, ambiguous_data['N'])
+                 for base in seq)
+
+
+def expand_ambiguous(choices: tuple, max_expand: int):
+    """
+    Expand ambiguous bases lazily. If there are more than max_expand
+    combinations, only max_expand combinations evenly distributed in all
+    combinations (index n*step, step is coprime to total) were used, thus the
+    result is deterministic and every combination appears at most once.
+    Args:
+        choices: possible bases of each position, from get_choices()
+        max_expand: maximum number of combinations
+    Yields:
+        bases: tuple of str
+    """
+    total = 1
+    for i in choices:
+        total *= len(i)
+    if total <= max_expand:
+        yield from cartesian_product(*choices)
+        return
+    step = total // max_expand
+    while gcd(step, total) != 1:
+        step += 1
+    for n in range(max_expand):
+        index = n * step % total
+        bases = []
+        for choice in reversed(choices):
+            index, remainder = divmod(index, len(choice))
+            bases.append(choice[remainder])
+        bases.reverse()
+        yield tuple(bases)
+
+
+def log_thermo_cache():
+    """
+    Log hit/miss counters of primer3 cache, including the caches of worker
+    processes of find_primer().
+    """
+    info = calc_thermo.cache_info()
+    if info.hits + info.misses == 0:
+        if not _WORKER_CACHE:
+            log.info('\tPrimer3 cache was not used.')
+            return
+        log.info(f'\tPrimer3 cache of main process was bypassed, candidates '
+                 f'were checked in {len(_WORKER_CACHE)} worker processes.')
+    hits, misses, size = info.hits, info.misses, info.currsize
+    for worker_hits, worker_misses, worker_size in _WORKER_CACHE.values():
+        hits += worker_hits
+        misses += worker_misses
+        size += worker_size
+    total = hits + misses
+    log.info(f'\tPrimer3 cache: {hits} hits, {misses} misses '
+             f'({hits/total:.1%} saved), {size} cached.')
+
+
+def calc_ambiguous_seq(func, seq, seq2=None, max_expand=MAX_EXPAND):
     """
     Expand sequences with ambiguous bases to several clean sequences and apply
     func to every sequence.
+    At most max_expand sequences (or pairs of sequences for seq2) were used,
+    see expand_ambiguous().
     Return average value. Return 0 if len(seq) > 60 (from primer3)
     """
     # Seems primer3 only accept seqs shorter than 60 bp. Plus, too long seq
     # will cost too much memory.
     LEN_LIMIT = 60
 
-    def _expand(seq):
-        seq_list = []
-        for base in seq:
-            # replace illegal base with 'N'
-            if base not in ambiguous_data:
-                base = 'N'
-            seq_list.append(ambiguous_data[base])
-        seq_product = list(cartesian_product(*seq_list))
-        seq_str = [''.join(i) for i in seq_product]
-        return seq_str
-
     if len(seq) > LEN_LIMIT:
         log.warning('Too many ambiguous bases. Skip')
         return 0
-    seq_str = _expand(seq)
+    choices = get_choices(str(seq))
     if seq2 is None:
-        values = [func(i) for i in seq_str]
+        values = [calc_thermo(func, ''.join(i))
+                  for i in expand_ambiguous(choices, max_expand)]
     else:
         if len(seq2) > LEN_LIMIT:
             log.warning('Too many ambiguous bases. Skip')
             return 0
-        seq_str2 = _expand(seq2)
-        products = cartesian_product(seq_str, seq_str2)
-        values = [func(i[0], i[1]) for i in products]
+        # expand two sequences together
+        split = len(choices)
+        choices += get_choices(str(seq2))
+        values = [calc_thermo(func, ''.join(i[:split]), ''.join(i[split:]))
+                  for i in expand_ambiguous(choices, max_expand)]
     # primer3 will return negative values sometime
     values_positive = [max(0, i) for i in values]
     return utils.safe_average(values_positive)
 
 
-def count_base(alignment: np.array):
+def get_base_table() -> np.array:
+    """
+    Lookup table for count_base().
+    Each row is the contribution of one code (see evaluate.get_code_table())
+    to [A, T, C, G, N, GAP, OTHER], multiplied by 6 to use integer, for
+    example, "M" (A|C) is [3, 0, 3, 0, 0, 0, 0].
+    Returns:
+        table: np.array, (evaluate.CODES, 7)
+    """
+    bits = (evaluate.A, evaluate.T, evaluate.C, evaluate.G)
+    # 6 is the least common multiple of 1, 2, 3
+    table = np.zeros((evaluate.CODES, 7), dtype=np.int64)
+    for code in range(1, evaluate.ANY):
+        for column, bit in enumerate(bits):
+            if code & bit:
+                table[code, column] = 6 // evaluate.BIT_COUNT[code]
+    table[evaluate.ANY, 4] = 6
+    table[evaluate.GAP, 5] = 6
+    table[evaluate.UNKNOWN, 6] = 6
+    return table
+
+
+BASE_TABLE = get_base_table()
+
+
+def count_base(alignment: np.array) -> np.array:
     """
     Given alignment numpy array, count cumulative frequency of base in each
     column (consider ambiguous base and "N", "-" and "?", otherwise omit).
-    Return [[float, float, float, float, float, float, float]] for
+    Return np.array, (columns, 7) for
     [A, T, C, G, N, GAP, OTHER].
     """
-    frequency = []
-    rows, columns = alignment.shape
-    for index in range(columns):
-        base, counts = np.unique(alignment[:, [index]], return_counts=True)
-        count_dict = {b'A': 0, b'C': 0, b'G': 0, b'T': 0, b'M': 0, b'R': 0,
-                      b'W': 0, b'S': 0, b'Y': 0, b'K': 0, b'V': 0, b'H': 0,
-                      b'D': 0, b'B': 0, b'X': 0, b'N': 0, b'-': 0, b'?': 0}
-        count_dict.update(dict(zip(base, counts)))
-        a = (count_dict[b'A'] +
-             (count_dict[b'D'] + count_dict[b'H'] + count_dict[b'V']) / 3 +
-             (count_dict[b'M'] + count_dict[b'R'] + count_dict[b'W']) / 2)
-        t = (count_dict[b'T'] +
-             (count_dict[b'B'] + count_dict[b'H'] + count_dict[b'D']) / 3 +
-             (count_dict[b'K'] + count_dict[b'W'] + count_dict[b'Y']) / 2)
-        c = (count_dict[b'C'] +
-             (count_dict[b'B'] + count_dict[b'H'] + count_dict[b'V']) / 3 +
-             (count_dict[b'M'] + count_dict[b'S'] + count_dict[b'Y']) / 2)
-        g = (count_dict[b'G'] +
-             (count_dict[b'B'] + count_dict[b'D'] + count_dict[b'V']) / 3 +
-             (count_dict[b'K'] + count_dict[b'R'] + count_dict[b'S']) / 2)
-        gap = count_dict[b'-']
-        n = count_dict[b'N'] + count_dict[b'X'] + count_dict[b'?']
-        other = rows - a - t - c - g - gap - n
-        frequency.append([a, t, c, g, n, gap, other])
+    bases, count = evaluate.count_column(alignment)
+    # ambiguous bases were splitted into fractions by the table
+    frequency = (count.T @ BASE_TABLE[bases]) / 6
     return frequency
 
 
@@ -346,14 +564,17 @@ def get_quality(data, rows):
     max_q = 62
     factor = max_q / rows
     # use min to avoid KeyError
-    quality_value = [min(max_q, int(i * factor)) - 1 for i in data]
-    return quality_value
+    quality_value = np.minimum(max_q, (np.asarray(data) * factor).astype(
+        np.int64)) - 1
+    return quality_value.tolist()
 
 
-def get_consensus(base_cumulative_frequency, coverage_percent: float,
-                  rows: int, output: Path):
+def get_consensus(base_cumulative_frequency: np.array,
+                  coverage_percent: float, rows: int, output: Path):
     """
-    Given count info of bases, return consensus(PrimerWithInfo).
+    Given count info of bases (from count_base), return
+    consensus(PrimerWithInfo).
+    All columns were handled at once.
     """
     def get_ambiguous_dict():
         data = dict(zip(ambiguous_data.values(), ambiguous_data.keys()))
@@ -364,42 +585,42 @@ def get_consensus(base_cumulative_frequency, coverage_percent: float,
         return data_with_len
 
     ambiguous_dict = get_ambiguous_dict()
-    most = []
-    coverage = rows * coverage_percent
-
+    # frequency of ambiguous bases are multiples of 1/6, use integer to avoid
+    # float error on comparison
+    frequency = np.rint(np.asarray(base_cumulative_frequency,
+                                   dtype=np.float64) * 6)
+    columns = len(frequency)
+    coverage = rows * coverage_percent * 6
     limit = coverage / len('ATCG')
-    for location, column in enumerate(base_cumulative_frequency):
-        finish = False
-        # "*" for others
-        value = dict(zip(list('ATCGN-*'), column))
-
-        base = 'N'
-        if value['N'] >= limit:
-            count = value['N']
-            most.append([location, base, count])
-            continue
-        sum_gap = value['-'] + value['*']
-        if sum_gap >= limit:
-            base = '-'
-            count = sum_gap
-            most.append([location, base, count])
-            continue
-        # 1 2 3 4
-        for length in ambiguous_dict:
-            # A T CG CT ACG CTG ATCG
-            for key in ambiguous_dict[length]:
-                count = 0
-                for letter in list(key):
-                    if finish:
-                        break
-                    count += value[letter]
-                    if count >= coverage:
-                        base = ambiguous_dict[length][key]
-                        finish = True
-                        most.append([location, base, count])
-    quality_raw = [i[2] for i in most]
-    consensus = PrimerWithInfo(start=1, seq=''.join([i[1] for i in most]),
-                               quality=get_quality(quality_raw, rows))
+    # "*" for others
+    value = dict(zip(list('ATCGN-*'), frequency.T))
+    # empty string for columns without enough coverage
+    base = np.full(columns, '', dtype='U1')
+    count = np.zeros(columns, dtype=np.float64)
+    undecided = np.ones(columns, dtype=np.bool_)
+
+    def assign(found, letter, found_count):
+        nonlocal undecided
+        found = found & undecided
+        base[found] = letter
+        count[found] = found_count[found]
+        undecided = undecided & ~found
+
+    assign(value['N'] >= limit, 'N', value['N'])
+    sum_gap = value['-'] + value['*']
+    assign(sum_gap >= limit, '-', sum_gap)
+    # 1 2 3 4
+    for length in ambiguous_dict:
+        # A T CG CT ACG CTG ATCG
+        for key in ambiguous_dict[length]:
+            key_count = np.zeros(columns, dtype=np.float64)
+            for letter in list(key):
+                key_count = key_count + value[letter]
+                assign(key_count >= coverage, ambiguous_dict[length][key],
+                       key_count)
+    keep = base != ''
+    consensus = PrimerWithInfo(start=1, seq=''.join(base[keep].tolist()),
+                               quality=get_quality(count[keep] / 6, rows))
     SeqIO.write(consensus, output, 'fastq')
     return consensus
 
@@ -435,85 +656,313 @@ def find_continuous(consensus, good_region, min_len):
     return consensus
 
 
+def get_candidate_mask(sequence: str, min_len: int, max_len: int,
+                       max_ambiguous: int) -> np.array:
+    """
+    Pre-filter primer candidates of every start and every length at once,
+    before any primer3 call. Candidates with too many ambiguous bases,
+    poly(NNNNN) structure or tandem repeat (NN*5) were removed, i.e., the
+    checks in find_primer.is_good_primer() without primer3.
+    Runs were marked by prefix sums, thus each candidate only need two
+    lookups for each check.
+    Args:
+        sequence: consensus sequence, upper case
+        min_len: minimum primer length
+        max_len: maximum primer length
+        max_ambiguous: maximum number of ambiguous bases
+    Returns:
+        mask: np.array(dtype=bool), shape (len(sequence),
+        max_len-min_len+1), True for candidate [start, start+min_len+i)
+    """
+    POLY = 5
+    TANDEM = 5 * 2
+
+    def cumsum(x):
+        result = np.zeros(len(x)+1, dtype=np.int32)
+        np.cumsum(x, out=result[1:])
+        return result
+
+    def window_all(x, size):
+        # all of x[i:i+size] are True
+        count = cumsum(x)
+        result = np.zeros(len(x), dtype=np.bool_)
+        if len(x) >= size:
+            result[:len(x)-size+1] = (count[size:]-count[:-size]) == size
+        return result
+
+    seq = np.frombuffer(sequence.encode('ascii', errors='replace'),
+                        dtype=np.uint8)
+    n = len(seq)
+    clean = np.isin(seq, np.frombuffer(b'ACGT', dtype=np.uint8))
+    # seq[i] == seq[i+1], seq[i] == seq[i+2]
+    same = np.zeros(n, dtype=np.bool_)
+    same[:-1] = seq[:-1] == seq[1:]
+    same2 = np.zeros(n, dtype=np.bool_)
+    same2[:-2] = seq[:-2] == seq[2:]
+    # ([ATCG])\1\1\1\1 starts from i
+    poly = clean & window_all(same, POLY-1)
+    # ([ATCG]{2})\1\1\1\1 starts from i
+    tandem = clean & np.roll(clean, -1) & window_all(same2, TANDEM-2)
+    ambiguous_count = cumsum(~clean)
+    poly_count = cumsum(poly)
+    tandem_count = cumsum(tandem)
+    starts = np.arange(n)[:, None]
+    ends = starts + np.arange(min_len, max_len+1)[None, :]
+    inside = ends <= n
+    ends = np.minimum(ends, n)
+    mask = inside & ((ambiguous_count[ends]-ambiguous_count[starts]) <=
+                     max_ambiguous)
+    # runs should be inside [start, end)
+    poly_end = np.maximum(starts, ends-POLY+1)
+    mask &= (poly_count[poly_end]-poly_count[starts]) == 0
+    tandem_end = np.maximum(starts, ends-TANDEM+1)
+    mask &= (tandem_count[tandem_end]-tandem_count[starts]) == 0
+    return mask
+
+
+def is_good_primer(seq: str, max_expand: int):
+    """
+    Use primer3 to check weather it's good primer.
+    ref1. http://www.premierbiosoft.com/tech_notes/PCR_Primer_Design.html
+    Args:
+        seq: primer sequence
+        max_expand: see calc_ambiguous_seq()
+    Returns:
+        (tm, hairpin_tm, homodimer_tm), None if it's bad primer
+    """
+    hairpin_tm = calc_ambiguous_seq(calcHairpinTm, seq, max_expand=max_expand)
+    tm = calc_ambiguous_seq(calcTm, seq, max_expand=max_expand)
+    # primer3.calcHairpin or calcHomodimer usually return structure found
+    # with low Tm. Here we compare structure_tm with sequence tm
+    if hairpin_tm >= tm:
+        # hairpin found
+        return None
+    homodimer_tm = calc_ambiguous_seq(calcHomodimerTm, seq,
+                                      max_expand=max_expand)
+    if homodimer_tm >= tm:
+        # homodimer found
+        return None
+    return tm, hairpin_tm, homodimer_tm
+
+
+def init_primer_worker(data=None):
+    """
+    Initialize worker process of check_primers_parallel(). Forked worker
+    inherits primer3 cache of the main process, only count its own calls.
+    Args:
+        data: bytes of consensus if shared memory is unavailable, else None
+    """
+    info = calc_thermo.cache_info()
+    _WORKER['cache_info'] = (info.hits, info.misses, info.currsize)
+    if data is not None:
+        _WORKER['name'] = None
+        _WORKER['sequence'] = data.decode('ascii')
+
+
+def load_primer_sequence(name, size: int) -> str:
+    """
+    Read consensus in worker process of check_primers_parallel(). The
+    consensus was read from shared memory once for each locus.
+    Args:
+        name: name of shared memory, None if the consensus was sent by
+        init_primer_worker()
+        size: length of consensus
+    Returns:
+        sequence: consensus sequence
+    """
+    if name is not None and _WORKER.get('name') != (name, size):
+        shm = shared_memory.SharedMemory(name=name)
+        data = bytes(shm.buf[:size])
+        shm.close()
+        _WORKER['name'] = (name, size)
+        _WORKER['sequence'] = data.decode('ascii')
+    return _WORKER['sequence']
+
+
+def check_primer_chunk(chunk: tuple) -> tuple:
+    """
+    Check one chunk of primer candidates in worker process.
+    Args:
+        chunk: (name, size, starts, lengths, max_expand), see
+        load_primer_sequence()
+    Returns:
+        results: list of is_good_primer() results
+        pid: id of the worker process
+        cache_info: (hits, misses, currsize) of calc_thermo() in the worker
+    """
+    name, size, starts, lengths, max_expand = chunk
+    sequence = load_primer_sequence(name, size)
+    results = [is_good_primer(sequence[start:start+length], max_expand)
+               for start, length in zip(starts, lengths)]
+    info = calc_thermo.cache_info()
+    base = _WORKER.get('cache_info', (0, 0, 0))
+    cache_info = (info.hits-base[0], info.misses-base[1],
+                  info.currsize-base[2])
+    return results, getpid(), cache_info
+
+
+def get_primer_pool(threads: int, data=None) -> ProcessPoolExecutor:
+    """
+    Get the process pool of check_primers_parallel(). The pool is created
+    once and shared by all loci, thus primer3 results cached in worker
+    processes could be reused by later loci.
+    If shared memory is unavailable (python < 3.8), the consensus is sent
+    once to each worker by the initializer, thus the pool is recreated for
+    each locus.
+    The pool is closed at exit if the caller did not close it.
+    Args:
+        threads: number of processes
+        data: bytes of consensus if shared memory is unavailable, else None
+    Returns:
+        pool: ProcessPoolExecutor
+    """
+    global _POOL, _POOL_DATA
+    if _POOL is not None and data != _POOL_DATA:
+        close_primer_pool()
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=threads,
+                                    initializer=init_primer_worker,
+                                    initargs=(data, ))
+        _POOL_DATA = data
+        atexit.register(close_primer_pool)
+    return _POOL
+
+
+def close_primer_pool():
+    """
+    Shutdown the process pool of check_primers_parallel() if it exists.
+    """
+    global _POOL, _POOL_DATA
+    if _POOL is not None:
+        atexit.unregister(close_primer_pool)
+        _POOL.shutdown()
+        _POOL = None
+        _POOL_DATA = None
+
+
+def check_primers_parallel(sequence: str, starts: list, lengths: list,
+                           max_expand: int, threads: int) -> list:
+    """
+    Check primer candidates by process pool. Candidates were splitted into
+    chunks of start positions, the consensus was sent to workers once,
+    through shared memory or the initializer of the pool. Cache counters
+    of workers were collected for log_thermo_cache().
+    Args:
+        sequence: consensus sequence
+        starts: start of candidates
+        lengths: length of candidates
+        max_expand: see calc_ambiguous_seq()
+        threads: number of processes
+    Returns:
+        results: list of is_good_primer() results, same order as candidates
+    """
+    data = sequence.encode('ascii', errors='replace')
+    chunk_size = min(PRIMER_CHUNK, -(-len(starts)//threads))
+    shm = None
+    name = None
+    results = []
+    try:
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(1, len(data)))
+            shm.buf[:len(data)] = data
+            name = shm.name
+            pool = get_primer_pool(threads)
+        else:
+            pool = get_primer_pool(threads, data)
+        chunks = [(name, len(data), starts[i:i+chunk_size],
+                   lengths[i:i+chunk_size], max_expand)
+                  for i in range(0, len(starts), chunk_size)]
+        for result, pid, cache_info in pool.map(check_primer_chunk, chunks):
+            results.extend(result)
+            _WORKER_CACHE[pid] = cache_info
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return results
+
+
 def find_primer(consensus, arg):
     """
     Find suitable primer in given consensus with features labeled as candidate
-    primer, return list of PrimerWithInfo, consensus.
-    """
-    # repeat no more than 5 times
-    poly = re.compile(r'([ATCG])\1\1\1\1')
-    tandem = re.compile(r'([ATCG]{2})\1\1\1\1')
-
-    def is_good_primer(primer):
-        # use re and primer3 to check weather it's good primer
-        # ref1. http://www.premierbiosoft.com/tech_notes/PCR_Primer_Design.html
-        ambiguous_base = len(primer)
-        for i in list('ATCG'):
-            ambiguous_base -= primer.seq.count(i)
-        if ambiguous_base > max_ambiguous:
-            return False
-        if re.search(poly, str(primer.seq)) is not None:
-            primer.detail = 'Poly(NNNNN) structure found'
-            return False
-        if re.search(tandem, str(primer.seq)) is not None:
-            primer.detail = 'Tandom(NN*5) exist'
-            return False
-        primer.hairpin_tm = calc_ambiguous_seq(calcHairpinTm, primer.seq)
-        primer.tm = primer.annotations['tm'] = calc_ambiguous_seq(calcTm,
-                                                                  primer.seq)
-        # primer3.calcHairpin or calcHomodimer usually return structure found
-        # with low Tm. Here we compare structure_tm with sequence tm
-        if primer.hairpin_tm >= primer.tm:
-            primer.detail = 'Hairpin found'
-            return False
-        primer.homodimer_tm = calc_ambiguous_seq(calcHomodimerTm, primer.seq)
-        if primer.homodimer_tm >= primer.tm:
-            primer.detail = 'Homodimer found'
-            return False
-        return True
-
-    primers = []
+    primer, return PrimerTable, consensus.
+    Candidates were pre-filtered by get_candidate_mask(), only survivors were
+    checked by primer3, in "threads" processes if there are many.
+    """
+    sequence = consensus.sequence
     min_len = arg.min_primer
     max_len = arg.max_primer
     max_ambiguous = arg.ambiguous_base_n
+    max_expand = arg.max_expand
+    mask = get_candidate_mask(consensus.sequence, min_len, max_len,
+                              max_ambiguous)
+    candidate_starts = []
+    candidate_lengths = []
     # skip good_region
-    continuous = consensus.features
-    for feature in continuous:
-        fragment = feature.extract(consensus)
-        len_fragment = len(fragment)
-        for begin in range(len_fragment - max_len):
-            for p_len in range(min_len, max_len + 1):
-                start = feature.location.start + begin
-                primer = consensus[start:start + p_len]
-                if is_good_primer(primer):
-                    consensus.features.append(SeqFeature(
-                        FeatureLocation(start, start + p_len),
-                        type='primer', strand=1))
-                    primer.start = start
-                    primer.update_id()
-                    primers.append(primer)
+    for feature in consensus.features:
+        len_fragment = len(feature)
+        # region shorter than max_len is skipped, like the old code
+        if len_fragment <= max_len:
+            continue
+        offset = int(feature.location.start)
+        begin, length = np.nonzero(mask[offset:offset+len_fragment-max_len])
+        candidate_starts.extend((begin+offset).tolist())
+        candidate_lengths.extend((length+min_len).tolist())
+    threads = max(1, arg.threads)
+    if threads > 1 and len(candidate_starts) > PRIMER_CHUNK:
+        log.info(f'Check {len(candidate_starts)} candidates with {threads} '
+                 f'processes.')
+        results = check_primers_parallel(sequence, candidate_starts,
+                                         candidate_lengths, max_expand,
+                                         threads)
+    else:
+        results = [is_good_primer(sequence[start:start+length], max_expand)
+                   for start, length in zip(candidate_starts,
+                                            candidate_lengths)]
+    starts = []
+    lengths = []
+    tms = []
+    hairpin_tms = []
+    homodimer_tms = []
+    for start, p_len, result in zip(candidate_starts, candidate_lengths,
+                                    results):
+        if result is None:
+            continue
+        consensus.features.append(SeqFeature(
+            FeatureLocation(start, start + p_len), type='primer', strand=1))
+        starts.append(start)
+        lengths.append(p_len)
+        tms.append(result[0])
+        hairpin_tms.append(result[1])
+        homodimer_tms.append(result[2])
+    primers = PrimerTable(sequence, consensus.quality, starts, lengths, tms,
+                          hairpin_tms, homodimer_tms)
     return primers, consensus
 
 
-def validate(primer_candidate: list, aln: Path, n_seqs: int, arg):
+def validate(primer_candidate: PrimerTable, aln: Path, n_seqs: int, arg):
     """
-    Do BLAST. Parse BLAST result. Return list of PrimerWithInfo which passed
-    the validation.
+    Do BLAST. Parse BLAST result. Return list of Primer which passed the
+    validation.
     """
     EVALUE = 1e-2
     _, blast = utils.get_blast()
     if not _:
         log.critical('Cannot find BLAST.')
         return []
+    _, makeblastdb = utils.get_makeblastdb()
+    if not _:
+        log.critical('Cannot find makeblastdb.')
+        return []
     locus_name = aln.stem
-    makeblastdb = Path(blast).parent / 'makeblastdb'
     query_file = arg._primer / (locus_name+'.candidate.fasta')
-    query_file_fastq = arg._primer / (locus_name+'.candidate.fastq')
-    # SeqIO.write fasta file directly is prohibited. have to write fastq at
-    # first.
-    with open(query_file_fastq, 'w', encoding='utf-8') as _:
-        SeqIO.write(primer_candidate, _, 'fastq')
-    SeqIO.convert(query_file_fastq, 'fastq', query_file, 'fasta')
+    ids = {}
+    with open(query_file, 'w', encoding='utf-8') as _:
+        for index in range(len(primer_candidate)):
+            primer_id = primer_candidate.get_id(index)
+            ids[primer_id] = index
+            _.write(f'>{primer_id}\n{primer_candidate.get_seq(index)}\n')
     # build blast db
     db_file = utils.move(aln, arg._tmp/(locus_name+'-db_file.fasta'), copy=True)
     _ = subprocess.run(f'{makeblastdb} -in {db_file} -dbtype nucl '
@@ -567,15 +1016,13 @@ def validate(primer_candidate: list, aln: Path, n_seqs: int, arg):
                 'avg_mismatch': sum_mismatch / good_hits,
                 'mid_loc': mid_loc}
     primer_verified = []
-    for primer in primer_candidate:
-        i = primer.id
-        if i in blast_result:
-            primer.coverage = blast_result[i]['coverage']
-            primer.avg_bitscore = blast_result[i]['avg_bitscore']
-            primer.mid_loc = blast_result[i]['mid_loc']
-            primer.avg_mismatch = blast_result[i]['avg_mismatch']
-            primer.update_id()
-            primer_verified.append(primer)
+    for index, primer_id in sorted((ids[i], i) for i in blast_result):
+        info = blast_result[primer_id]
+        primer_candidate.coverage[index] = info['coverage']
+        primer_candidate.avg_bitscore[index] = info['avg_bitscore']
+        primer_candidate.avg_mismatch[index] = info['avg_mismatch']
+        primer_verified.append(primer_candidate.get_primer(index,
+                                                           info['mid_loc']))
     primer_verified.sort(key=lambda x: x.start)
     # clean
     utils.clean_tmp(db_file)
@@ -630,7 +1077,7 @@ def pick_pair(primers, alignment, arg):
         len(pairs) - len(less_pairs)))
     good_pairs = []
     for i in less_pairs:
-        i.add_info(alignment)
+        i.add_info(alignment, arg.max_expand)
         if i.observed_res >= arg.resolution:
             good_pairs.append(i)
     good_pairs.sort(key=lambda x: x.score, reverse=True)
@@ -651,12 +1098,10 @@ def get_observed_res(alignment: np.array, arg):
     """
     index = []
     observed_res_list = []
-    rows, columns = alignment.shape
-    for i in range(0, columns, arg.step):
-        subalign = alignment[:, i:i+arg.size]
-        sub_rows, sub_columns = subalign.shape
-        item, count = np.unique(subalign, return_counts=True, axis=0)
-        observed_res = len(count) / sub_rows
+    window = evaluate.SlidingWindow(alignment, arg.size, arg.step)
+    for i, end in window.windows():
+        count = window.count_haplotype(i, end)
+        observed_res = len(count) / window.rows
         index.append(i)
         observed_res_list.append(observed_res)
     return index, observed_res_list
@@ -664,7 +1109,8 @@ def get_observed_res(alignment: np.array, arg):
 
 def primer_design(aln: Path, result: Path, arg):
     locus_name = aln.stem
-    name, alignment, = evaluate.fasta_to_array(aln)
+    name, alignment, = evaluate.fasta_to_array(aln,
+                                               arg._tmp/(aln.name+'.npy'))
     if name is None:
         log.info(f'Invalid alignment file {aln}.')
         return False
@@ -676,7 +1122,7 @@ def primer_design(aln: Path, result: Path, arg):
                               arg._align/(locus_name+'-consensus.fastq'))
     log.info(f'Evaluate whole alignment of {aln}.')
     # a_ : alignment
-    item, count = np.unique(alignment, return_counts=True, axis=0)
+    count = evaluate.count_haplotype(alignment)
     observed_res = len(count) / rows
     if observed_res < arg.resolution:
         log.error('Observed resolution is too low.')
@@ -695,6 +1141,7 @@ def primer_design(aln: Path, result: Path, arg):
                     'Please consider to loose options.')
         return True
     log.info(f'Found {len(primer_candidate)} candidate primers.')
+    log_thermo_cache()
     log.info('Validate with BLAST. May be slow.')
     primer_verified = validate(primer_candidate, aln, rows, arg)
     if len(primer_verified) == 0:
@@ -703,6 +1150,8 @@ def primer_design(aln: Path, result: Path, arg):
         return True
     log.info('Picking primer pairs.')
     pairs = pick_pair(primer_verified, alignment, arg)
+    log_thermo_cache()
+    evaluate.get_tree_cache().save()
     if len(pairs) == 0:
         log.warning('Cannot find suitable primer pairs. '
                     'Please consider to loose options.')
@@ -718,8 +1167,8 @@ def primer_design(aln: Path, result: Path, arg):
         line = f'{locus_name},{rows},{str(pair)}\n'
         out2.write(line)
         out3.write(line)
-        SeqIO.write(pair.left, out1, 'fastq')
-        SeqIO.write(pair.right, out1, 'fastq')
+        SeqIO.write(pair.left.to_record(), out1, 'fastq')
+        SeqIO.write(pair.right.to_record(), out1, 'fastq')
     out1.close()
     out2.close()
     out3.close()
@@ -748,8 +1197,11 @@ def primer_main():
     if arg is None:
         log.info('Quit.')
         return None, None
-    for aln in arg.aln:
-        primer_design(aln, primer_result, arg)
+    try:
+        for aln in arg.aln:
+            primer_design(aln, primer_result, arg)
+    finally:
+        close_primer_pool()
 
     log.info(f'Primer result could be found in {primer_result}')
     log.info('Primer module Finished.')
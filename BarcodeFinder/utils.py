@@ -1,17 +1,20 @@
 #!/usr/bin/python3
 
 import re
+import json
+import argparse
 import logging
 import platform
 import subprocess
 
-from collections import Iterable
+from collections import OrderedDict
+from collections.abc import Iterable
 from functools import lru_cache
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 from pathlib import Path
 from urllib.request import urlopen
-from shutil import unpack_archive
+from shutil import unpack_archive, which
 
 from Bio.Seq import Seq
 
@@ -26,6 +29,12 @@ try:
 except ImportError:
     pass
 
+# paths and versions of third-party software, see lookup_tool()
+TOOLS_FILE = 'tools.json'
+_tools = {}
+_tools_checked = set()
+_tools_lock = Lock()
+
 
 class BlastResult:
     # slightly faster than namedtuple
@@ -48,6 +57,97 @@ class BlastResult:
                           self.hit_end)
 
 
+class WriterPool:
+    """
+    Opened files for appending, keyed by filename.
+    If too many files were opened, the least recently used one was closed
+    (flushed) and would be reopened in append mode on next use. All files
+    were closed on close() or leaving "with" block.
+    """
+    __slots__ = ('max_open', '_handles')
+
+    def __init__(self, max_open=None):
+        if max_open is None:
+            max_open = get_max_open()
+        self.max_open = max(1, max_open)
+        self._handles = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, filename: Path):
+        """
+        Return opened handle of the file.
+        """
+        handle = self._handles.get(filename, None)
+        if handle is not None:
+            self._handles.move_to_end(filename)
+            return handle
+        while len(self._handles) >= self.max_open:
+            _, old = self._handles.popitem(last=False)
+            old.close()
+        handle = open(filename, 'a', encoding='utf-8')
+        self._handles[filename] = handle
+        return handle
+
+    def write(self, filename: Path, text: str):
+        self.get(filename).write(text)
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+
+def get_max_open() -> int:
+    """
+    Number of files could be opened by WriterPool, i.e., half of the limit of
+    file descriptors, at most 4096.
+    If the soft limit is low, try to raise it (never above the hard limit).
+    Returns:
+        max_open: int
+    """
+    wanted = 8192
+    # Windows default limit of C runtime
+    limit = 512
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            new_soft = wanted
+            if hard != resource.RLIM_INFINITY:
+                new_soft = min(hard, wanted)
+            if new_soft > soft:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+                soft = new_soft
+        limit = wanted if soft == resource.RLIM_INFINITY else soft
+    except (ImportError, OSError, ValueError):
+        pass
+    return max(8, min(limit // 2, 4096))
+
+
+def positive_int(value: str) -> int:
+    """
+    Type of argparse options that must be positive integers.
+    Args:
+        value: option string
+    Returns:
+        number: int
+    Raises:
+        argparse.ArgumentTypeError: if it's not a positive integer
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'should be at least 1: {value}')
+    return number
+
+
 def arg_to_str(arg) ->str:
     s = ''
     arg_dict = vars(arg)
@@ -335,11 +435,106 @@ def test_cmd(program, option='-version') -> bool:
     return success
 
 
+def get_version(program, option='-version') -> (bool, str):
+    """
+    Like test_cmd(), but also return the first line of output as version.
+    Args:
+        program(Path or str): program path
+        option(str): option to show version
+    Return:
+        success(bool): success or not
+        version(str): version info, empty if failed
+    """
+    test = subprocess.run(f'{program} {option}', shell=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+    if test.returncode != 0:
+        return False, ''
+    output = test.stdout.decode('utf-8', errors='ignore').strip()
+    version = output.splitlines()[0] if output else ''
+    return True, version
+
+
+def load_tools(third_party: Path) -> dict:
+    """
+    Load the registry of third-party software from disk.
+    Only read once per process.
+    Args:
+        third_party(Path): third_party folder
+    Return:
+        _tools(dict): {name: {'path': str, 'version': str}}
+    """
+    if _tools:
+        return _tools
+    tools_file = third_party / TOOLS_FILE
+    if tools_file.exists():
+        try:
+            with open(tools_file, 'r', encoding='utf-8') as _:
+                _tools.update(json.load(_))
+        except Exception:
+            log.debug(f'Bad tool registry {tools_file}, ignore it.')
+    return _tools
+
+
+def lookup_tool(name: str, third_party: Path) -> str:
+    """
+    Get registered path of given program.
+    Registered path is checked by shutil.which() instead of running the
+    program, and only checked once per process.
+    Args:
+        name(str): program name
+        third_party(Path): third_party folder
+    Return:
+        path(str): program path, empty if not registered or not exists
+    """
+    with _tools_lock:
+        info = load_tools(third_party).get(name, None)
+        if info is None:
+            return ''
+        path = info['path']
+        if name in _tools_checked:
+            return path
+        if which(path) is None:
+            log.debug(f'Registered {name} ({path}) is missing.')
+            del _tools[name]
+            return ''
+        _tools_checked.add(name)
+    return path
+
+
+def register_tool(name: str, path: str, version: str,
+                  third_party: Path) -> None:
+    """
+    Add program to the registry and save it to disk.
+    Args:
+        name(str): program name
+        path(str): program path
+        version(str): version info
+        third_party(Path): third_party folder
+    """
+    with _tools_lock:
+        load_tools(third_party)
+        _tools[name] = {'path': str(path), 'version': version}
+        _tools_checked.add(name)
+        tools_file = third_party / TOOLS_FILE
+        tmp_file = tools_file.with_suffix('.tmp')
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as _:
+                json.dump(_tools, _, indent=4, sort_keys=True)
+            tmp_file.replace(tools_file)
+        except Exception:
+            log.debug(f'Failed to save tool registry {tools_file}.')
+    log.debug(f'Register {name}: {path} {version}')
+    return
+
+
+@lru_cache(maxsize=None)
 def get_third_party():
     """
     Get third_party folder.
     If do not exist, create it.
     If cannot access, report.
+    Will cache results.
     Return:
         success(bool): ok or not
         third_party(Path): absolute path of third_party folder
@@ -366,6 +561,7 @@ def get_blast(third_party=None, result=None) -> (bool, str):
     """
     Get BLAST location.
     If BLAST was found, assume makeblastdb is found, too.
+    Use registered path if possible, see lookup_tool().
     If not found, download it.
     Args:
         third_party(Path or None): path for install
@@ -389,7 +585,11 @@ def get_blast(third_party=None, result=None) -> (bool, str):
     urls = {'Linux': url+'-x64-linux.tar.gz',
             'Darwin': url+'-x64-macosx.tar.gz',
             'Windows': url+'-x64-win64.tar.gz'}
-    if test_cmd(blast):
+    registered = lookup_tool(blast, third_party)
+    if registered:
+        ok = True
+        home_blast = registered
+    elif test_cmd(blast):
         ok = True
         home_blast = str(blast)
     elif test_cmd(home_blast):
@@ -426,14 +626,64 @@ def get_blast(third_party=None, result=None) -> (bool, str):
             assert test_cmd(home_blast, '-version')
             ok = True
             break
+    if ok and not registered:
+        _, version = get_version(home_blast)
+        register_tool(blast, home_blast, version, third_party)
+        makeblastdb = get_makeblastdb_path(home_blast)
+        _, version = get_version(makeblastdb)
+        register_tool('makeblastdb', makeblastdb, version, third_party)
     if result is not None:
         result.put(('BLAST', ok))
     return ok, str(home_blast)
 
 
+def get_makeblastdb_path(blast: str) -> str:
+    """
+    Makeblastdb is in the same folder with blastn.
+    Args:
+        blast(str): blastn path
+    Return:
+        makeblastdb(str): makeblastdb path
+    """
+    blast = Path(blast)
+    if blast.parent == Path('.'):
+        # found in $PATH
+        return 'makeblastdb'
+    return str(blast.with_name('makeblastdb'))
+
+
+def get_makeblastdb(third_party=None) -> (bool, str):
+    """
+    Get makeblastdb location, which is registered along with BLAST.
+    Args:
+        third_party(Path or None): path for install
+    Return:
+        ok(bool): success or not
+        makeblastdb(str): makeblastdb path
+    """
+    if third_party is None:
+        third_party_ok, third_party = get_third_party()
+        if not third_party_ok:
+            return third_party_ok, ''
+    makeblastdb = lookup_tool('makeblastdb', third_party)
+    if makeblastdb:
+        return True, makeblastdb
+    ok, blast = get_blast(third_party)
+    if not ok:
+        return ok, ''
+    makeblastdb = lookup_tool('makeblastdb', third_party)
+    if not makeblastdb:
+        # blastn was registered by old version without makeblastdb
+        makeblastdb = get_makeblastdb_path(blast)
+        _, version = get_version(makeblastdb)
+        register_tool('makeblastdb', makeblastdb, version, third_party)
+    return True, makeblastdb
+
+
 def get_iqtree(third_party=None, result=None) -> (bool, str):
     """
     Get iqtree location.
+    Use registered path if possible, see lookup_tool().
     If not found, download it.
     Args:
         third_party(Path or None): path for install
@@ -458,7 +708,11 @@ def get_iqtree(third_party=None, result=None) -> (bool, str):
     system = platform.system()
     filename = fileinfo[system][0]
     home_iqtree = third_party / fileinfo[system][1] / 'bin' / iqtree
-    if test_cmd(iqtree):
+    registered = lookup_tool(iqtree, third_party)
+    if registered:
+        ok = True
+        home_iqtree = registered
+    elif test_cmd(iqtree):
         ok = True
         home_iqtree = str(iqtree)
     elif test_cmd(home_iqtree):
@@ -495,6 +749,9 @@ def get_iqtree(third_party=None, result=None) -> (bool, str):
             assert test_cmd(home_iqtree, '-version')
             ok = True
             break
+    if ok and not registered:
+        _, version = get_version(home_iqtree)
+        register_tool(iqtree, home_iqtree, version, third_party)
     if result is not None:
         result.put(('IQTREE', ok))
     return ok, str(home_iqtree)
@@ -503,6 +760,7 @@ def get_iqtree(third_party=None, result=None) -> (bool, str):
 def get_mafft(third_party=None, result=None) -> (bool, str):
     """
     Get iqtree location.
+    Use registered path if possible, see lookup_tool().
     If not found, download it.
     Args:
         third_party(Path or None): path for install
@@ -528,7 +786,11 @@ def get_mafft(third_party=None, result=None) -> (bool, str):
                 'Darwin': ('mafft-7.475-mac.zip', 'mafft-mac'),
                 'Windows': ('mafft-7.475-win64-signed.zip', 'mafft-win')}
     home_mafft = third_party / fileinfo[system][1] / mafft
-    if test_cmd(mafft, '--version'):
+    registered = lookup_tool(mafft, third_party)
+    if registered:
+        ok = True
+        home_mafft = registered
+    elif test_cmd(mafft, '--version'):
         ok = True
         home_mafft = str(mafft)
     elif test_cmd(home_mafft, '--version'):
@@ -567,6 +829,9 @@ def get_mafft(third_party=None, result=None) -> (bool, str):
             assert test_cmd(home_mafft, '--version')
             ok = True
             break
+    if ok and not registered:
+        _, version = get_version(home_mafft, '--version')
+        register_tool(mafft, home_mafft, version, third_party)
     if result is not None:
         result.put(('MAFFT', ok))
     return ok, str(home_mafft)
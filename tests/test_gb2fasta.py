@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from Bio import Entrez
+
+from BarcodeFinder import gb2fasta, utils
+
+EUTILS = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+ESEARCH = '''<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">
+<eSearchResult><Count>{count}</Count><RetMax>0</RetMax><RetStart>0</RetStart>
+<QueryKey>1</QueryKey><WebEnv>FAKE</WebEnv><IdList></IdList>
+<TranslationSet></TranslationSet><QueryTranslation>{term}</QueryTranslation>
+</eSearchResult>
+'''
+EPOST = '''<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE ePostResult PUBLIC "-//NLM//DTD epost 20090526//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">
+<ePostResult><QueryKey>{key}</QueryKey><WebEnv>FAKE</WebEnv></ePostResult>
+'''
+
+
+def make_record(n: int) -> bytes:
+    """
+    Minimal genbank record, enough for scan_gb() and GenBankCache.
+    """
+    return (f'LOCUS       FAKE{n:05d}                 8 bp    DNA     linear'
+            f'   PLN 01-JAN-2020\n'
+            f'ACCESSION   FAKE{n:05d}\n'
+            f'VERSION     FAKE{n:05d}.1\n'
+            f'ORIGIN      \n'
+            f'        1 acgtacgt\n'
+            f'//\n').encode('utf-8')
+
+
+class FakeEntrez:
+    """
+    Stand-in of esearch/epost/efetch of NCBI E-utilities.
+    """
+    def __init__(self, records: list):
+        self.records = records
+        # query_key: records
+        self.queries = {'1': records}
+        # retstart of efetch (rettype=gb) that always fail
+        self.fail = set()
+        # number of epost requests to fail
+        self.post_errors = 0
+        # (time, cgi, params)
+        self.requests = []
+        self.lock = Lock()
+
+    def efetch_starts(self) -> list:
+        return [int(params['retstart']) for _, cgi, params in self.requests
+                if cgi == 'efetch.fcgi' and params.get('rettype') == 'gb']
+
+    def handle(self, cgi: str, params: dict) -> (int, str, bytes):
+        with self.lock:
+            self.requests.append((monotonic(), cgi, params))
+        if cgi == 'esearch.fcgi':
+            text = ESEARCH.format(count=len(self.records),
+                                  term=params.get('term', ''))
+            return 200, 'text/xml', text.encode('utf-8')
+        if cgi == 'epost.fcgi':
+            ids = set(params['id'].split(','))
+            with self.lock:
+                if self.post_errors > 0:
+                    self.post_errors -= 1
+                    return 500, 'text/plain', b'Internal server error'
+                key = str(len(self.queries) + 1)
+                self.queries[key] = [i for i in self.records
+                                     if gb2fasta.GenBankCache.get_key(i)
+                                     in ids]
+            return 200, 'text/xml', EPOST.format(key=key).encode('utf-8')
+        if cgi == 'efetch.fcgi':
+            records = self.queries[params['query_key']]
+            start = int(params['retstart'])
+            batch = records[start:start+int(params['retmax'])]
+            if params['rettype'] == 'acc':
+                text = b''.join(gb2fasta.GenBankCache.get_key(i).encode(
+                    'utf-8') + b'\n' for i in batch)
+                return 200, 'text/plain', text
+            if start in self.fail:
+                return 500, 'text/plain', b'Internal server error'
+            return 200, 'text/plain', b''.join(batch)
+        return 404, 'text/plain', b''
+
+
+@pytest.fixture
+def entrez(monkeypatch):
+    """
+    Start a FakeEntrez http server and point Bio.Entrez to it.
+    """
+    fake = FakeEntrez([make_record(i) for i in range(25)])
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, params: dict):
+            cgi = urlsplit(self.path).path.rsplit('/', 1)[-1]
+            params = {key: value[0] for key, value in params.items()}
+            code, content_type, body = fake.handle(cgi, params)
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(parse_qs(urlsplit(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self.reply(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}/'
+    build_request = Entrez._build_request
+
+    def local_request(cgi, *args, **kwargs):
+        return build_request(cgi.replace(EUTILS, base), *args, **kwargs)
+
+    monkeypatch.setattr(Entrez, '_build_request', local_request)
+    # leave retry and rate limit to gb2fasta
+    monkeypatch.setattr(Entrez, 'max_tries', 1)
+    monkeypatch.setattr(Entrez, 'api_key', 'fake')
+    monkeypatch.setattr(gb2fasta, 'RETRY_MAX', 1)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def arg(tmp_path, monkeypatch):
+    """
+    Arguments of download(), without local genbank cache.
+    """
+    monkeypatch.setattr(utils, 'get_third_party',
+                        lambda: (False, tmp_path / 'third_party'))
+    arg = SimpleNamespace(query='fake[organism]', email=None, seq_n=0,
+                          taxon=None, organelle=None, gene=None,
+                          _tmp=tmp_path / 'Temp', _gb=tmp_path / 'GenBank')
+    arg._tmp.mkdir()
+    arg._gb.mkdir()
+    return arg
+
+
+def test_rate_limiter():
+    limiter = gb2fasta.RateLimiter(20)
+    times = []
+    lock = Lock()
+
+    def job():
+        for _ in range(5):
+            limiter.wait()
+            with lock:
+                times.append(monotonic())
+
+    threads = [Thread(target=job) for _ in range(4)]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    times.sort()
+    assert len(times) == 20
+    # the first request does not wait
+    assert times[-1] - start >= 19 / 20 - 0.01
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / 20 - 0.01
+
+
+def test_download_respects_rate(entrez, arg, monkeypatch):
+    rate = 5
+    monkeypatch.setattr(gb2fasta, 'ENTREZ_RATE', rate)
+    gbfile = gb2fasta.download(arg)
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+    assert sorted(entrez.efetch_starts()) == [0, 10, 20]
+    # esearch and efetch share the limit
+    times = [t for t, _, _ in entrez.requests]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / rate - 0.05
+    # part files were removed after download
+    assert not (arg._tmp / 'download').exists() or not any(
+        (arg._tmp / 'download').iterdir())
+
+
+def test_download_resume(entrez, arg, monkeypatch):
+    fetch_batch = gb2fasta.fetch_batch
+
+    def interrupted(query_handle, ret_start, *args):
+        if ret_start == 20:
+            raise KeyboardInterrupt
+        return fetch_batch(query_handle, ret_start, *args)
+
+    monkeypatch.setattr(gb2fasta, 'fetch_batch', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        gb2fasta.download(arg)
+    manifest_file = next((arg._tmp / 'download').glob(
+        f'*/{gb2fasta.MANIFEST_FILE}'))
+    manifest = json.loads(manifest_file.read_text())
+    assert sorted(manifest['done']) == ['0', '10']
+
+    monkeypatch.setattr(gb2fasta, 'fetch_batch', fetch_batch)
+    n_requests = len(entrez.efetch_starts())
+    gbfile = gb2fasta.download(arg)
+    # only the unfinished batch was downloaded again
+    assert entrez.efetch_starts()[n_requests:] == [20]
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+
+
+def test_download_skip_failed_batch(entrez, arg):
+    entrez.fail.add(10)
+    gbfile = gb2fasta.download(arg)
+    # other batches were still downloaded
+    records = entrez.records[:10] + entrez.records[20:]
+    assert gbfile.read_bytes() == b''.join(records)
+    # first try and one retry
+    assert entrez.efetch_starts().count(10) == 1 + gb2fasta.RETRY_MAX
+    manifest = json.loads((arg._tmp / 'Download.json').read_text())
+    assert manifest['failed'] == [10]
+    assert sorted(manifest['done']) == ['0', '20']
+
+    entrez.fail.clear()
+    n_requests = len(entrez.efetch_starts())
+    gbfile = gb2fasta.download(arg)
+    assert entrez.efetch_starts()[n_requests:] == [10]
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+    manifest = json.loads((arg._tmp / 'Download.json').read_text())
+    assert manifest['failed'] == []
+
+
+def test_download_with_cache(entrez, arg, tmp_path, monkeypatch):
+    third_party = tmp_path / 'third_party'
+    third_party.mkdir()
+    monkeypatch.setattr(utils, 'get_third_party', lambda: (True, third_party))
+    old = entrez.records[:]
+    entrez.records[:] = old[:15]
+    gb2fasta.download(arg)
+    entrez.records[:] = old
+    # epost failed once, then retried
+    entrez.post_errors = 1
+    n_requests = len(entrez.efetch_starts())
+    gbfile = gb2fasta.download(arg)
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+    # only records missing in the cache were downloaded
+    assert entrez.efetch_starts()[n_requests:] == [0]
+    posted = [params for _, cgi, params in entrez.requests
+              if cgi == 'epost.fcgi']
+    assert len(posted) == 2
+    assert posted[-1]['id'].split(',') == [
+        gb2fasta.GenBankCache.get_key(i) for i in old[15:]]
+
+
+def test_cache_record_without_version(entrez, arg, tmp_path, monkeypatch):
+    third_party = tmp_path / 'third_party'
+    third_party.mkdir()
+    monkeypatch.setattr(utils, 'get_third_party', lambda: (True, third_party))
+    no_version = entrez.records[3].replace(b'VERSION     FAKE00003.1\n', b'')
+    no_accession = entrez.records[4].replace(
+        b'ACCESSION   FAKE00004\nVERSION     FAKE00004.1\n', b'')
+    entrez.records[3:5] = [no_version, no_accession]
+    assert gb2fasta.GenBankCache.get_key(no_version) == 'FAKE00003'
+    gbfile = gb2fasta.download(arg)
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+    cache = gb2fasta.get_genbank_cache()
+    assert len(cache) == len(entrez.records)
+    # all records were found in cache in the next run
+    n_requests = len(entrez.efetch_starts())
+    gbfile = gb2fasta.download(arg)
+    assert entrez.efetch_starts()[n_requests:] == []
+    assert gbfile.read_bytes() == b''.join(entrez.records)
+
+
+def test_scan_gb_blank_lines(tmp_path):
+    gbfile = tmp_path / 'blank.gb'
+    records = [make_record(i) for i in range(3)]
+    gbfile.write_bytes(b'\n' + b'\n\n'.join(records) + b'\n  \n')
+    chunks = list(gb2fasta.scan_gb(gbfile))
+    assert [data for _, data in chunks] == records
+    for start, data in chunks:
+        assert data.startswith(b'LOCUS')
+        # fast parser, not Biopython
+        record = gb2fasta.parse_gb_record(data)
+        assert record.id == gb2fasta.GenBankCache.get_key(data)
+    assert gb2fasta.parse_gb_record(b'\n\n' + records[0]).id == 'FAKE00000.1'
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+import random
+import sys
+from types import SimpleNamespace
+
+import pytest
+from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+from BarcodeFinder import primer
+
+
+@pytest.mark.parametrize('value', ['0', '-1', 'x'])
+def test_max_expand_rejects_bad_value(value, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['primer', '-max_expand', value])
+    with pytest.raises(SystemExit):
+        primer.parse_args()
+
+
+def test_max_expand(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['primer', '-max_expand', '1'])
+    arg, _ = primer.parse_args()
+    assert arg.max_expand == 1
+    choices = primer.get_choices('NNNN')
+    assert len(list(primer.expand_ambiguous(choices, arg.max_expand))) == 1
+
+
+def test_find_primer_short_region():
+    random.seed(0)
+    sequence = ''.join(random.choice('ACGT') for _ in range(300))
+    consensus = primer.PrimerWithInfo(seq=sequence,
+                                      quality=[40] * len(sequence))
+    # shorter than max_primer, no primer could be found in it
+    consensus.features.append(SeqFeature(FeatureLocation(0, 22),
+                                         type='continuous'))
+    arg = SimpleNamespace(min_primer=20, max_primer=25, ambiguous_base_n=4,
+                          max_expand=primer.MAX_EXPAND, threads=1)
+    primers, consensus = primer.find_primer(consensus, arg)
+    assert len(primers) == 0